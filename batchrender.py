@@ -0,0 +1,71 @@
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from fonts import get_font
+
+# =========== #
+textLayerCacheSize = 4096  # Rasterized text layers kept per render worker
+# =========== #
+
+# Composites a whole batch of cards as one (N, 512, 512, 4) array. Both blends below reproduce
+# Pillow's integer math exactly, so cards match the per-card PIL path byte for byte:
+#   Image.paste(overlay, mask=overlay)   every band: div255(dst * (255 - a) + src * a)
+#   ImageDraw.text(fill=white) on RGBA   same with the glyph coverage m, except colour bands of a fully
+#                                        transparent pixel take the ink outright wherever m > 0
+
+
+def div255(value):
+    value = value + 128
+    return ((value >> 8) + value) >> 8
+
+
+@lru_cache(maxsize=textLayerCacheSize)
+def text_layer(font_path, size, text, x, y):
+    # Glyph coverage of ImageDraw.text((x, y), text, anchor='ms') cropped to its bounding box, as
+    # (top, left, mask). Drawing white on a black L image leaves exactly the coverage behind.
+    canvas = Image.new('L', (512, 512))
+    ImageDraw.Draw(canvas).text((x, y), text, font=get_font(font_path, size), fill=255, anchor='ms')
+    box = canvas.getbbox()
+    if box is None:
+        return None
+    return box[1], box[0], np.asarray(canvas.crop(box), dtype=np.uint16)
+
+
+def stamp(region, mask):
+    # White text onto region (cards, h, w, 4) through a (h, w) coverage mask, in place.
+    alpha = region[..., 3]
+    color_mask = np.where((alpha == 0) & (mask != 0), 255, mask)[..., None]
+    region[..., :3] = div255(region[..., :3] * (255 - color_mask) + 255 * color_mask)
+    region[..., 3] = div255(alpha * (255 - mask) + 255 * mask)
+
+
+def compose(backgrounds, overlay, layers, font_path):
+    # backgrounds: 512x512 RGBA images, overlay: (512, 512, 4) uint16 array,
+    # layers: per card, the (text, size, (x, y)) it gets in drawing order. Returns (N, 512, 512, 4) uint8.
+    batch = np.stack([np.asarray(background) for background in backgrounds]).astype(np.uint16)
+    alpha = overlay[..., 3:]
+    batch = div255(batch * (255 - alpha) + overlay * alpha)  # uint16 holds 255 * 255 + 255
+
+    # Cards sharing a layer (same price, same "LAST SEEN" text) get it stamped in one go.
+    for depth in range(max((len(card) for card in layers), default=0)):
+        groups = {}
+        for index, card in enumerate(layers):
+            if depth < len(card):
+                text, size, (x, y) = card[depth]
+                groups.setdefault((text, size, x, y), []).append(index)
+        for (text, size, x, y), indices in groups.items():
+            layer = text_layer(font_path, size, text, x, y)
+            if layer is None:
+                continue
+            top, left, mask = layer
+            window = np.s_[top:top + mask.shape[0], left:left + mask.shape[1]]
+            if len(indices) == len(layers):
+                stamp(batch[(slice(None),) + window], mask)
+            else:
+                region = batch[(indices,) + window]
+                stamp(region, mask)
+                batch[(indices,) + window] = region
+
+    return batch.astype(np.uint8)
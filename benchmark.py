@@ -0,0 +1,439 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+from aiohttp import web
+from PIL import Image
+
+# Offline benchmark of the generation pipeline: replays /v2/shop fixtures against a local
+# stand-in for the image CDN and reports wall time, CPU time and peak RSS per stage.
+#
+#   python benchmark.py --sizes 30 100 250 --runs 3 --latency 40 --output results.json
+#   python benchmark.py --fixture recorded.json --compare results.json
+#   python benchmark.py --snapshot latest  (shops from the server's snapshot store, see snapshotstore.py)
+#   python benchmark.py --backend numpy --verify  (numpy card backend, checked against PIL)
+#   python benchmark.py --record recorded.json  (saves the live shop, the only online mode)
+#
+# Stages nest the way the pipeline runs them: "shop merge" includes "shop encode".
+
+# =========== #
+benchmarkSizes = (30, 100, 250)  # Entries per generated fixture
+benchmarkRuns = 3  # Runs per fixture, the first one starts with empty caches
+benchmarkLatency = 40  # Milliseconds the image server waits before answering
+benchmarkImageSize = 512  # Side of the images the image server hands out
+benchmarkTolerance = 0.2  # --compare fails when a stage got this much slower...
+benchmarkMinDelta = 0.05  # ...and by at least this many seconds, so tiny stages don't flap
+benchmarkPort = 0  # Port of the image server, 0 picks a free one
+# =========== #
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+LIVE_SHOP_URL = 'https://fortnite-api.com/v2/shop?responseFlags=0x7'
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def make_fixture(size, seed=0):
+    # A /v2/shop response shaped like the real one, with image urls to be pointed at the local server.
+    rng = random.Random(seed * 100003 + size)
+    today = date(2024, 10, 1)
+    entries = []
+    for i in range(size):
+        history = [(today - timedelta(days=rng.randint(1, 1500))).isoformat() + 'T00:00:00Z' for _ in range(rng.randint(0, 6))]
+        history.sort()
+        history.append(today.isoformat() + 'T00:00:00Z')
+        item = {
+            'id': f'CID_{i:04d}_Bench',
+            'name': f'Bench Item {i} ' + 'X' * rng.randint(0, 14),
+            'type': {'value': 'outfit', 'displayValue': 'Outfit'},
+            'images': {'icon': f'https://cdn.invalid/items/{i}/icon.png'},
+            'shopHistory': history,
+        }
+        if rng.random() < 0.5:
+            item['newDisplayAsset'] = {'renderImages': [{'image': f'https://cdn.invalid/items/{i}/render.png'}]}
+        entry = {
+            'finalPrice': rng.choice((500, 800, 1200, 1500, 2000)),
+            'brItems': [item],
+            'newDisplayAsset': {'materialInstances': [{'images': {'OfferImage': f'https://cdn.invalid/offers/{i}.png'}}]},
+        }
+        if rng.random() < 0.1:
+            entry['bundle'] = {'name': f'Bench Bundle {i}', 'image': f'https://cdn.invalid/bundles/{i}.png'}
+        entries.append(entry)
+    return {'status': 200, 'data': {'hash': f'bench{size:04d}', 'date': today.isoformat() + 'T00:00:00Z', 'entries': entries}}
+
+
+def point_urls_at(value, base, names):
+    # Every url in the fixture becomes base/{digest}.png, so recorded shops replay offline too.
+    if isinstance(value, dict):
+        return {key: point_urls_at(item, base, names) for key, item in value.items()}
+    if isinstance(value, list):
+        return [point_urls_at(item, base, names) for item in value]
+    if isinstance(value, str) and value.startswith(('http://', 'https://')):
+        name = f'{hashlib.sha1(value.encode("utf-8")).hexdigest()}.png'
+        names.add(name)
+        return f'{base}/{name}'
+    return value
+
+
+def make_image(name, size):
+    rng = random.Random(name)
+    noise = Image.effect_noise((size, size), rng.randint(20, 80))
+    color = Image.new('RGBA', (size, size), (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255), 255))
+    color.putalpha(noise)
+    out = io.BytesIO()
+    color.save(out, format='PNG')
+    return out.getvalue()
+
+
+class ImageServer:
+    # Stand-in for the cosmetic CDN: deterministic PNGs with ETags, after a fixed delay.
+
+    def __init__(self, latency, image_size, port=benchmarkPort):
+        self.latency = latency / 1000
+        self.image_size = image_size
+        self.port = port
+        self.images = {}
+        self.requests = 0
+        self.runner = None
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        name = request.match_info['name']
+        etag = f'"{name}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        if name not in self.images:
+            return web.Response(status=404)
+        return web.Response(body=self.images[name], content_type='image/png', headers={'ETag': etag})
+
+    def prepare(self, names):
+        # Encoded up front, so the server's own PNG encoding doesn't end up in the download stage.
+        for name in names:
+            if name not in self.images:
+                self.images[name] = make_image(name, self.image_size)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/img/{name}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f'http://127.0.0.1:{self.port}/img'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def proc_stat(pid):
+    # (cpu seconds, rss bytes) of a process, from /proc where there is one.
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, int(fields[21]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0.0, 0
+
+
+def worker_pids():
+    import render
+    pool = render._pool
+    return list(getattr(pool, '_processes', None) or {}) if pool else []
+
+
+def cpu_seconds():
+    # This process plus the render workers, which do most of the work.
+    return time.process_time() + sum(proc_stat(pid)[0] for pid in worker_pids())
+
+
+def rss_bytes():
+    return sum(proc_stat(pid)[1] for pid in [os.getpid()] + worker_pids())
+
+
+class BenchJob:
+    # Passed to genshop/ogitems in place of a jobs.Job, so the pipeline's own stages get measured.
+
+    def __init__(self, workdir, interval=0.005):
+        self.workdir = workdir
+        self.stages = []
+        self.active = []
+        self.interval = interval
+        self.stop = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            rss = rss_bytes()
+            for stage in list(self.active):
+                stage['peak_rss'] = max(stage['peak_rss'], rss)
+
+    @contextmanager
+    def stage(self, name):
+        stage = {'stage': name, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': rss_bytes()}
+        self.active.append(stage)
+        wall, cpu = time.perf_counter(), cpu_seconds()
+        try:
+            yield
+        finally:
+            stage['wall'] = round(time.perf_counter() - wall, 4)
+            stage['cpu'] = round(cpu_seconds() - cpu, 4)
+            stage['peak_rss'] = max(stage['peak_rss'], rss_bytes())
+            self.active.remove(stage)
+            self.stages.append(stage)
+
+
+def prepare_workdir():
+    # The pipeline works relative to its cwd, so runs happen in a scratch copy of the tree's inputs.
+    workdir = tempfile.mkdtemp(prefix='shopbench-')
+    for name in ('assets', 'static', 'templates'):
+        os.makedirs(os.path.join(workdir, name))
+        for filename in os.listdir(os.path.join(REPO, name)):
+            os.symlink(os.path.join(REPO, name, filename), os.path.join(workdir, name, filename))
+    for name in ('shops/og', 'shops/custom', 'shops/archive/og', 'work'):
+        os.makedirs(os.path.join(workdir, name))
+    shopbg = os.path.join(workdir, 'assets', 'shopbg.png')
+    if not os.path.exists(shopbg):
+        print("[BENCH] assets/shopbg.png is missing, using a plain background.", file=sys.stderr)
+        Image.new('RGBA', (256, 256), (20, 20, 80, 255)).save(shopbg)
+    return workdir
+
+
+async def run_once(main, raw, cold, pipeline='stream'):
+    if cold:
+        for directory in ('imagecache', 'cardcache'):
+            shutil.rmtree(directory, ignore_errors=True)
+        main.image_cache.index = None
+
+    job = BenchJob(os.path.join('work', 'bench'))
+    os.makedirs(job.workdir, exist_ok=True)
+    job.sampler.start()
+    try:
+        with job.stage('total'):
+            with job.stage('parse'):
+                shop_data = json.loads(raw)['data']
+                entries = main.normalize_shop(shop_data)[1]
+            if pipeline == 'stream':
+                await main.generate_shop(main.http_client, shop_data, shop_data['hash'], entries, job=job)
+            else:
+                # What regeneration did before stream_cards: download, render and merge one image at a time.
+                await main.genshop(main.http_client, shop_data, shop_data['hash'], entries=entries, job=job)
+                if main.checkForOgItems:
+                    await main.ogitems(main.http_client, shop_data, shop_data['hash'], entries=entries, job=job)
+    finally:
+        job.stop.set()
+        job.sampler.join()
+    return job.stages, entries
+
+
+def verify_backends(main, entries):
+    # Draws every card of the shop with both backends in this process and counts the ones that differ.
+    import batchrender
+    import render
+    if not render.batch_backend_ok(main.overlayPath, main.itemShopFont):
+        return None
+    cards = [
+        (entry.source, render.card_layers(entry.name, render.last_seen_text(entry.diff), entry.price))
+        for entry in entries if entry.source
+    ]
+    mismatches = 0
+    for i in range(0, len(cards), render.renderBatchSize):
+        batch = cards[i:i + render.renderBatchSize]
+        backgrounds = [render.open_background(source) for source, _ in batch]
+        composed = batchrender.compose(backgrounds, render._overlay_array, [layers for _, layers in batch], render._font_path)
+        for background, (_, layers), card in zip(backgrounds, batch, composed):
+            mismatches += render.draw_card(background, layers).tobytes() != card.tobytes()
+    return {'cards': len(cards), 'mismatches': mismatches}
+
+
+async def run_benchmark(args):
+    server = ImageServer(args.latency, args.image_size)
+    base = await server.start()
+
+    fixtures = []
+    for path in args.fixture or []:
+        with open(path, 'r') as f:
+            fixtures.append((os.path.basename(path), json.load(f)))
+    fixtures.extend(snapshot_fixtures(args.snapshot or []))
+    if not fixtures:
+        fixtures = [(f'generated-{size}', make_fixture(size)) for size in args.sizes]
+
+    cwd = os.getcwd()
+    workdir = prepare_workdir()
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+    import main
+    import render
+
+    results = []
+    try:
+        await main.http_client.start()
+        render.start_pool(main.overlayPath, main.itemShopFont, args.workers, args.backend)
+
+        for name, fixture in fixtures:
+            names = set()
+            raw = json.dumps(point_urls_at(fixture, base, names)).encode('utf-8')
+            server.prepare(names)
+            # Fresh caches for every fixture, then cold only where asked for.
+            for directory in ('imagecache', 'cardcache'):
+                shutil.rmtree(directory, ignore_errors=True)
+            main.image_cache.index = None
+            for run in range(args.runs):
+                cold = run == 0 or args.cold
+                requests = server.requests
+                stages, entries = await run_once(main, raw, cold, args.pipeline)
+                results.append({
+                    'fixture': name,
+                    'entries': len(fixture['data'].get('entries') or []),
+                    'run': run,
+                    'cold': cold,
+                    'image_requests': server.requests - requests,
+                    'stages': stages,
+                })
+                if args.verify and run == 0:
+                    results[-1]['verify'] = verify_backends(main, entries)
+                    print(f"[BENCH] {name} backends: {results[-1]['verify']}", file=sys.stderr)
+                total = next(stage for stage in stages if stage['stage'] == 'total')
+                print(f"[BENCH] {name} run {run} ({'cold' if cold else 'warm'}): {total['wall']:.2f}s wall, "
+                      f"{total['cpu']:.2f}s cpu, {total['peak_rss'] / 2 ** 20:.0f} MB peak", file=sys.stderr)
+    finally:
+        render.shutdown_pool()
+        await main.http_client.close()
+        await server.stop()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'created': time.time(),
+            'python': platform.python_version(),
+            'pillow': Image.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'render_workers': args.workers or os.cpu_count(),
+            'render_backend': render._backend,
+            'pipeline': args.pipeline,
+            'latency_ms': args.latency,
+            'image_size': args.image_size,
+            'runs': args.runs,
+        },
+        'results': results,
+    }
+
+
+def summarize(report):
+    # Median wall time per (fixture, warm/cold, stage).
+    samples = {}
+    for result in report['results']:
+        for stage in result['stages']:
+            key = (result['fixture'], 'cold' if result['cold'] else 'warm', stage['stage'])
+            samples.setdefault(key, []).append(stage['wall'])
+    return {key: sorted(values)[len(values) // 2] for key, values in samples.items()}
+
+
+def compare(report, baseline, tolerance):
+    # Prints every stage next to the baseline, returns False if any stage regressed beyond tolerance.
+    ok = True
+    before = summarize(baseline)
+    for key, wall in sorted(summarize(report).items()):
+        if key not in before:
+            continue
+        old = before[key]
+        change = (wall - old) / old if old else 0.0
+        regressed = change > tolerance and wall - old > benchmarkMinDelta
+        ok = ok and not regressed
+        print(f"{'REGRESSED' if regressed else 'ok':>9}  {' / '.join(key):<50} {old:8.3f}s -> {wall:8.3f}s ({change:+.0%})")
+    return ok
+
+
+def snapshot_fixtures(hashes):
+    # The store lives in the tree, relative to it like the server sees it.
+    import snapshotstore
+    cwd = os.getcwd()
+    os.chdir(REPO)
+    try:
+        fixtures = []
+        for shop_hash in hashes:
+            if shop_hash == 'latest':
+                shop_hash = snapshotstore.latest()
+            body = snapshotstore.load_body(shop_hash) if shop_hash else None
+            if body is None:
+                raise SystemExit(f"No snapshot {shop_hash} in {os.path.join(REPO, snapshotstore.snapshotDir)}")
+            fixtures.append((f'snapshot-{shop_hash}', json.loads(body)))
+        return fixtures
+    finally:
+        os.chdir(cwd)
+
+
+async def record(path):
+    from httpclient import HttpClient
+    client = HttpClient()
+    try:
+        resp = await client.fetch(LIVE_SHOP_URL)
+    finally:
+        await client.close()
+    if resp.status != 200:
+        raise SystemExit(f"fortnite-api.com returned {resp.status}")
+    with open(path, 'wb') as f:
+        f.write(resp.body)
+    print(f"[BENCH] Recorded {len(resp.json()['data'].get('entries') or [])} entries to {path}.", file=sys.stderr)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the shop generation pipeline.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(benchmarkSizes), help="entries per generated fixture")
+    parser.add_argument('--fixture', action='append', help="replay a recorded /v2/shop response instead (repeatable)")
+    parser.add_argument('--snapshot', action='append', metavar='HASH', help="replay a shop from the snapshot store, or 'latest' (repeatable)")
+    parser.add_argument('--runs', type=int, default=benchmarkRuns, help="runs per fixture, the first is always cold")
+    parser.add_argument('--cold', action='store_true', help="empty the image and card caches before every run")
+    parser.add_argument('--latency', type=float, default=benchmarkLatency, help="image server latency in ms")
+    parser.add_argument('--image-size', type=int, default=benchmarkImageSize, help="side of the served images in px")
+    parser.add_argument('--workers', type=int, help="render processes (default: every core)")
+    parser.add_argument('--backend', choices=('pil', 'numpy'), help="card render backend (default: render.renderBackend)")
+    parser.add_argument('--pipeline', choices=('stream', 'sequential'), default='stream', help="regeneration as it runs now, or one stage after the other")
+    parser.add_argument('--verify', action='store_true', help="check the numpy backend draws every card exactly like PIL")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--compare', help="a previous JSON report to compare against, exits 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=benchmarkTolerance, help="allowed slowdown per stage for --compare")
+    parser.add_argument('--record', metavar='PATH', help="save the live shop as a fixture and exit")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.record:
+        asyncio.run(record(args.record))
+        return
+
+    report = asyncio.run(run_benchmark(args))
+    body = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(body)
+    else:
+        print(body)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+    if any((result.get('verify') or {}).get('mismatches') for result in report['results']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import os
+import hashlib
+
+from logs import get_logger
+
+# =========== #
+cardCacheDir = 'cardcache'  # Where rendered 512x512 cards are kept between runs
+cardCacheMaxCards = 2000  # Evict least recently used cards above this count
+# =========== #
+
+log = get_logger('cardcache')
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def card_key(source, name, diff_text, price, overlay_digest, font_path):
+    # Raw downloads are content-addressed (see imagecache.py), so the file name is already the digest.
+    source_digest = os.path.splitext(os.path.basename(source))[0]
+    h = hashlib.sha1()
+    for part in (source_digest, name, diff_text, str(price), overlay_digest, font_path):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class CardCache:
+    # Rendered cards keyed by everything that affects their pixels. Safe to share between
+    # the render worker processes since every entry is a single file written atomically.
+
+    def __init__(self, directory=cardCacheDir, max_cards=cardCacheMaxCards):
+        self.directory = directory
+        self.max_cards = max_cards
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f'{key}.png')
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            os.utime(path)  # mtime doubles as the LRU clock
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, img):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f'{self.path_for(key)}.{os.getpid()}.tmp'
+        img.save(tmp_path, format='PNG', compress_level=1)
+        os.replace(tmp_path, self.path_for(key))
+
+    def evict(self):
+        if not os.path.isdir(self.directory):
+            return
+        entries = [e for e in os.scandir(self.directory) if e.name.endswith('.png')]
+        if len(entries) <= self.max_cards:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_cards]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        log.info("Evicted cards", extra={'evicted': len(entries) - self.max_cards})
@@ -0,0 +1,81 @@
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from logs import get_logger
+
+# =========== #
+cardOutput = True  # Also save every card of a generated shop on its own, for /api/v1/shop/items
+cardDir = 'shops/cards'  # One folder per shop hash, served by the /shops mount
+cardQuality = 80  # WebP quality, cards keep their transparent corners
+cardShopsKept = 8  # Newest shops whose cards stay on disk
+cardThreads = 4  # Cards encoded at the same time
+# =========== #
+
+log = get_logger('cardfiles')
+
+# Layout: {hash}/{name}.webp, name being the card's filename in the render (see card_name).
+# Normal cards are named after the cosmetic id (zzz + bundle name for bundles), OG cards OG + id.
+
+_pool = None
+
+
+def pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(cardThreads, thread_name_prefix='cardfiles')
+    return _pool
+
+
+def card_name(filename):
+    # Bundle names have spaces and whatever else, keep URLs plain.
+    return re.sub(r'[^A-Za-z0-9_-]', '_', filename)
+
+
+def card_link(shop_hash, filename):
+    return f'/shops/cards/{shop_hash}/{card_name(filename)}.webp'
+
+
+def save_card(card, path):
+    card.save(path, format='WEBP', quality=cardQuality, method=4)
+
+
+def save(shop_hash, cards):
+    # cards maps render filename -> 512x512 RGBA card. The folder is written aside and moved into
+    # place whole, so a shop either has all of its cards or none, and one that has them is done.
+    # Returns None when it already was.
+    folder = os.path.join(cardDir, shop_hash)
+    if os.path.isdir(folder):
+        return None
+    tmp_dir = os.path.join(cardDir, f'.{shop_hash}-{os.getpid()}.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    paths = [os.path.join(tmp_dir, f'{card_name(filename)}.webp') for filename in cards]
+    list(pool().map(save_card, cards.values(), paths))
+
+    try:
+        os.rename(tmp_dir, folder)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)  # Another process got there first
+        return None
+    log.info("Saved cards", extra={'hash': shop_hash, 'cards': len(paths)})
+    prune()
+    return folder
+
+
+def saved(shop_hash):
+    # Names of the cards saved for a shop, empty if it has none.
+    folder = os.path.join(cardDir, shop_hash)
+    if not os.path.isdir(folder):
+        return set()
+    return {os.path.splitext(entry.name)[0] for entry in os.scandir(folder) if entry.name.endswith('.webp')}
+
+
+def prune():
+    if not os.path.isdir(cardDir):
+        return
+    folders = [entry for entry in os.scandir(cardDir) if entry.is_dir() and not entry.name.startswith('.')]
+    folders.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in folders[cardShopsKept:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
@@ -0,0 +1,210 @@
+import base64
+import binascii
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from datetime import date
+
+from PIL import Image
+
+from logs import get_logger
+
+# =========== #
+catalogPath = 'catalog.db'  # Index of every generated shop image (kept outside the public shops/ mount)
+shopsDir = 'shops'
+# =========== #
+
+log = get_logger('catalog')
+
+# path is relative to shops/ so "/shops/" + path is the public link.
+# name is the shop hash for shop/og images and the saveAs name for custom ones.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    key TEXT NOT NULL DEFAULT '',
+    date TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    archived INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_archive ON images (archived, kind, date, name);
+CREATE INDEX IF NOT EXISTS images_name ON images (name);
+CREATE INDEX IF NOT EXISTS images_custom ON images (kind, key, path);
+"""
+
+
+def connect():
+    db = sqlite3.connect(catalogPath)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def relative(path):
+    return os.path.relpath(path, shopsDir).replace(os.sep, '/')
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything encode_cursor didn't make, every cursor is a pair of plain values.
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        raise ValueError("Invalid cursor.")
+    if not isinstance(values, list) or len(values) != 2 or not all(isinstance(value, (str, int, float)) for value in values):
+        raise ValueError("Invalid cursor.")
+    return values
+
+
+INSERT = ("INSERT OR REPLACE INTO images (path, kind, name, key, date, size, width, height, archived, created) "
+          "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+def row_for(path, kind, name, shop_date, width, height, key=''):
+    path = relative(path)
+    return (path, kind, name, key, shop_date, os.path.getsize(os.path.join(shopsDir, path)), width, height,
+            int(path.startswith('archive/')), time.time())
+
+
+def record(path, kind, name, shop_date, width, height, key=''):
+    with closing(connect()) as db, db:
+        db.execute(INSERT, row_for(path, kind, name, shop_date, width, height, key))
+
+
+def current_images(exclude_name):
+    with closing(connect()) as db:
+        return [dict(row) for row in db.execute(
+            "SELECT path, kind FROM images WHERE archived = 0 AND kind IN ('shop', 'og') AND name != ?",
+            (exclude_name,)
+        )]
+
+
+def forget(path):
+    with closing(connect()) as db, db:
+        db.execute("DELETE FROM images WHERE path = ?", (relative(path),))
+
+
+def mark_archived(old_path, new_path):
+    # A shop hash can come back after it was archived, its new archive copy replaces the old one.
+    with closing(connect()) as db, db:
+        db.execute("UPDATE OR REPLACE images SET path = ?, archived = 1 WHERE path = ?", (relative(new_path), relative(old_path)))
+
+
+def archive_page(limit, cursor=None, since=None, until=None):
+    # One page of archived shops grouped by hash, newest first. Returns (rows, next_cursor).
+    where = ["archived = 1", "kind IN ('shop', 'og')"]
+    params = []
+    if since:
+        where.append("date >= ?")
+        params.append(since)
+    if until:
+        where.append("date <= ?")
+        params.append(until)
+
+    having = ""
+    if cursor:
+        having = "HAVING (MAX(date), name) < (?, ?)"
+        params.extend(decode_cursor(cursor))
+
+    with closing(connect()) as db:
+        names = db.execute(
+            f"SELECT name, MAX(date) AS date FROM images WHERE {' AND '.join(where)} "
+            f"GROUP BY name {having} ORDER BY date DESC, name DESC LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+        next_cursor = encode_cursor([names[limit - 1]['date'], names[limit - 1]['name']]) if len(names) > limit else None
+        names = [row['name'] for row in names[:limit]]
+        rows = db.execute(
+            f"SELECT * FROM images WHERE archived = 1 AND kind IN ('shop', 'og') "
+            f"AND name IN ({','.join('?' * len(names))}) ORDER BY date DESC, name DESC",
+            names
+        ).fetchall() if names else []
+    return [dict(row) for row in rows], next_cursor
+
+
+def lookup(name):
+    with closing(connect()) as db:
+        return [dict(row) for row in db.execute("SELECT * FROM images WHERE name = ?", (name,))]
+
+
+def custom_page(limit, cursor=None, key=None, since=None, until=None):
+    where = ["kind = 'custom'"]
+    params = []
+    if key is not None:
+        where.append("key = ?")
+        params.append(key)
+    if since:
+        where.append("date >= ?")
+        params.append(since)
+    if until:
+        where.append("date <= ?")
+        params.append(until)
+    if cursor:
+        where.append("(key, path) > (?, ?)")
+        params.extend(decode_cursor(cursor))
+
+    with closing(connect()) as db:
+        rows = db.execute(
+            f"SELECT * FROM images WHERE {' AND '.join(where)} ORDER BY key, path LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+    next_cursor = encode_cursor([rows[limit - 1]['key'], rows[limit - 1]['path']]) if len(rows) > limit else None
+    return [dict(row) for row in rows[:limit]], next_cursor
+
+
+def has_custom_key(key):
+    with closing(connect()) as db:
+        return db.execute("SELECT 1 FROM images WHERE kind = 'custom' AND key = ? LIMIT 1", (key,)).fetchone() is not None
+
+
+def classify(path):
+    # (kind, name, key) for a file under shops/, or None if it isn't a shop image.
+    parts = relative(path).split('/')
+    filename = parts[-1]
+    if not filename.endswith('.jpg'):
+        return None
+    stem = filename[:-4]
+    if parts[0] == 'custom' and len(parts) == 3:
+        return 'custom', stem, parts[1]
+    if stem.startswith('shop-') and parts[:-1] in ([], ['archive']):
+        return 'shop', stem.split('-')[1], ''
+    if stem.startswith('og-') and parts[:-1] in (['og'], ['archive', 'og']):
+        return 'og', stem.split('-')[1], ''
+    return None
+
+
+def bootstrap():
+    # First start with a catalog: index whatever is already on disk, dated by file mtime.
+    with closing(connect()) as db:
+        if db.execute("SELECT 1 FROM images LIMIT 1").fetchone():
+            return
+
+    rows = []
+    for root, _, files in os.walk(shopsDir):
+        for filename in files:
+            path = os.path.join(root, filename)
+            info = classify(path)
+            if info is None:
+                continue
+            kind, name, key = info
+            try:
+                with Image.open(path) as img:
+                    width, height = img.size
+            except OSError:
+                continue
+            shop_date = date.fromtimestamp(os.path.getmtime(path)).isoformat()
+            rows.append(row_for(path, kind, name, shop_date, width, height, key))
+
+    with closing(connect()) as db, db:
+        db.executemany(INSERT, rows)
+    log.info("Indexed existing images", extra={'images': len(rows)})
@@ -0,0 +1,62 @@
+import asyncio
+import json
+import time
+from collections import deque
+
+# =========== #
+eventHistorySize = 50  # Events kept for Last-Event-ID replay
+eventQueueSize = 16  # Events buffered per client before a slow client is dropped
+eventKeepAlive = 15  # Seconds between keep-alive comments on an idle stream
+# =========== #
+
+
+class EventBroadcaster:
+    # In-process fan-out for Server-Sent Events, every connected client gets its own small queue.
+
+    def __init__(self):
+        self.history = deque(maxlen=eventHistorySize)
+        self.subscribers = set()
+        self.last_id = 0
+
+    def publish(self, event, data):
+        # Millisecond ids keep increasing across restarts, so an old Last-Event-ID still replays correctly.
+        self.last_id = max(self.last_id + 1, int(time.time() * 1000))
+        message = f"id: {self.last_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+        self.history.append((self.last_id, message))
+
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too far behind, end its stream; it can reconnect with Last-Event-ID and replay.
+                self.drop(queue)
+
+    def drop(self, queue):
+        self.subscribers.discard(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def close(self):
+        for queue in list(self.subscribers):
+            self.drop(queue)
+
+    async def stream(self, last_event_id=None):
+        queue = asyncio.Queue(maxsize=eventQueueSize)
+        self.subscribers.add(queue)
+        try:
+            if last_event_id is not None:
+                for event_id, message in list(self.history):
+                    if event_id > last_event_id:
+                        yield message
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), eventKeepAlive)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.subscribers.discard(queue)
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import os
+import time
+
+from logs import get_logger
+
+# =========== #
+fnggItemsUrl = 'https://fortnite.gg/api/items.json'
+fnggIndexFile = 'fngg.json'  # On-disk copy of the index for fast warm starts
+fnggRefreshInterval = 6 * 60 * 60  # Seconds between refreshes of the index
+fnggRetryInterval = 5 * 60  # Seconds before trying again after a failed refresh
+# =========== #
+
+log = get_logger('fngg')
+
+
+def video_url(fnggid):
+    return f'https://fnggcdn.com/items/{fnggid}/video.mp4'
+
+
+def build_index(resp):
+    return {key.lower(): value for key, value in resp.json().items()}
+
+
+class FnggIndex:
+    # Lowercased cosmetic id -> fortnite.gg id. Requests only ever read self.items, the
+    # background task swaps in a new dict when fortnite.gg has something newer.
+
+    def __init__(self, path=fnggIndexFile):
+        self.path = path
+        self.items = {}
+        self.etag = None
+        self.last_modified = None
+        self.updated = 0
+
+    @property
+    def loaded(self):
+        return bool(self.items)
+
+    def lookup(self, cosmeticid):
+        return self.items.get(cosmeticid.lower())
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning("Could not read the index", extra={'path': self.path, 'error': str(e)})
+            return
+        self.items = data['items']
+        self.etag = data.get('etag')
+        self.last_modified = data.get('last_modified')
+        self.updated = data.get('updated', 0)
+        log.info("Loaded index", extra={'items': len(self.items), 'path': self.path})
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'etag': self.etag,
+                'last_modified': self.last_modified,
+                'updated': self.updated,
+                'items': self.items,
+            }, f)
+        os.replace(tmp_path, self.path)
+
+    async def refresh(self, client):
+        headers = {}
+        if self.loaded:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+
+        resp = await client.fetch(fnggItemsUrl, headers=headers)
+        if resp.status == 304:
+            self.updated = time.time()
+            log.info("Index is up to date")
+        elif resp.status == 200:
+            # Several MB of JSON, decoded off the event loop so requests keep being served meanwhile.
+            self.items = await asyncio.to_thread(build_index, resp)
+            self.etag = resp.headers.get('ETag')
+            self.last_modified = resp.headers.get('Last-Modified')
+            self.updated = time.time()
+            log.info("Index refreshed", extra={'items': len(self.items)})
+        else:
+            raise RuntimeError(f"fortnite.gg returned {resp.status}")
+        await asyncio.to_thread(self.save)
+
+    async def run(self, client):
+        await asyncio.to_thread(self.load)
+        while True:
+            wait = self.updated + fnggRefreshInterval - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                await self.refresh(client)
+            except Exception as e:
+                log.warning("Failed to refresh index", extra={'error': str(e)})
+                await asyncio.sleep(fnggRetryInterval)
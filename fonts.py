@@ -0,0 +1,37 @@
+from functools import lru_cache
+from PIL import Image, ImageFont, ImageDraw
+
+# Fonts and text measurements are reused across every card and every merge of a process,
+# so both are cached here instead of being parsed / measured again each time.
+
+_measure_draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+
+
+@lru_cache(maxsize=256)
+def get_font(path, size):
+    return ImageFont.truetype(path, size)
+
+
+@lru_cache(maxsize=4096)
+def measure_text(path, size, text):
+    font = get_font(path, size)
+    try:
+        bbox = _measure_draw.textbbox((0, 0), text, font=font)
+        return bbox[2] - bbox[0], bbox[3] - bbox[1]
+    except AttributeError:
+        return _measure_draw.textsize(text, font=font)
+
+
+def largest_fitting_size(fits, low, high, step=2):
+    # Largest size in low, low + step, ..., high for which fits(size) holds, or None.
+    # Assumes fits is monotonic (true up to some size, false after it).
+    lo, hi = 0, (high - low) // step
+    best = None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if fits(low + mid * step):
+            best = low + mid * step
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    return best
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+
+# =========== #
+renderedShopsKept = 1  # Shops whose rendered cards stay in memory for custom renders (~1 MB per card, plus two grids)
+customResultsKept = 256  # Finished custom renders remembered by their parameters
+customResultDir = 'customresults'  # Private copies of those (a custom shop's own files get overwritten by the next request)
+snapshotsKept = 32  # Parsed shops kept for /api/v1/og and /api/v1/shop/items, a few hundred KB each
+itemIndexesKept = 32  # Item indexes kept for /api/v1/shop/items, one per shop hash
+ogRendersKept = 128  # Merged /api/v1/og images kept on disk, per (hash, threshold)
+ogRenderDir = 'ogrenders'  # Where those live (not under shops/, they're served by /api/v1/og/image)
+# =========== #
+
+
+class LRU(OrderedDict):
+    def __init__(self, maxsize, on_evict=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            evicted = self.popitem(last=False)
+            if self.on_evict:
+                self.on_evict(*evicted)
+        return value
+
+
+class RenderedShop:
+    # What a custom render of an already generated shop needs, so it can skip fetch, download and render.
+    __slots__ = ('hash', 'date', 'entries', 'cards', 'og_cards', 'grids')
+
+    def __init__(self, shop_hash, shop_date, entries):
+        self.hash = shop_hash
+        self.date = shop_date
+        self.entries = entries
+        self.cards = None  # Normal cards, in merge order
+        self.og_cards = {}  # OG card per cosmetic id, for every threshold rendered so far
+        # ('shop',) / ('og', threshold) -> composed RGB grid, 0.75 MB per card slot (~200 MB for a
+        # 250 card shop), and a merge holds its final canvas on top of it. So only the normal grid
+        # and the default threshold's OG grid are kept (see keep_grid in main.py).
+        self.grids = {}
+
+    @property
+    def shop_data(self):
+        # Just enough of /v2/shop for genshop and ogitems when they are given entries.
+        return {'hash': self.hash, 'date': self.date}
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_og_render(key, path):
+    remove_file(path)
+
+
+def remove_custom_result(params, result):
+    for path in result[1:]:
+        if path:
+            remove_file(path)
+
+
+rendered_shops = LRU(renderedShopsKept)
+custom_results = LRU(customResultsKept, on_evict=remove_custom_result)  # params -> (date, normal copy, og copy or None)
+snapshots = LRU(snapshotsKept)  # hash -> (date, entries)
+og_renders = LRU(ogRendersKept, on_evict=remove_og_render)  # (hash, threshold) -> path
+item_indexes = LRU(itemIndexesKept)  # hash -> shopitems.ItemIndex
+
+
+def rendered_shop(shop_hash, shop_data, entries, fresh=False):
+    # fresh drops whatever was kept for this hash, a regeneration always renders from scratch.
+    shop = None if fresh else rendered_shops.get(shop_hash)
+    if shop is None:
+        shop = rendered_shops.put(shop_hash, RenderedShop(shop_hash, shop_data['date'], entries))
+    snapshots.put(shop_hash, (shop.date, shop.entries))
+    return shop
+
+
+def shop_for(shop_hash):
+    # The kept RenderedShop for a hash, or a throwaway one built from its snapshot so an old
+    # shop doesn't push the current one out of rendered_shops. None without a snapshot.
+    shop = rendered_shops.get(shop_hash)
+    if shop is None and shop_hash in snapshots:
+        shop_date, entries = snapshots.get(shop_hash)
+        shop = RenderedShop(shop_hash, shop_date, entries)
+    return shop
+
+
+def og_render_path(shop_hash, threshold):
+    return os.path.join(ogRenderDir, f'og-{shop_hash}-{threshold}.jpg')
+
+
+def og_render(shop_hash, threshold):
+    # Path of the merged OG image for (hash, threshold) if it's already been rendered.
+    path = og_renders.get((shop_hash, threshold))
+    if path and os.path.exists(path):
+        return path
+    return None
+
+
+def clear_og_renders():
+    # Files from a previous run aren't in og_renders, so nothing would ever evict them.
+    shutil.rmtree(ogRenderDir, ignore_errors=True)
+
+
+def keep_custom_result(params, shop_date, normal_path, og_path):
+    # Copies a finished custom render aside under its parameters, so a later request with the same
+    # parameters gets this render even after another one overwrote the files it was saved as.
+    os.makedirs(customResultDir, exist_ok=True)
+    name = hashlib.sha1(repr(params).encode('utf-8')).hexdigest()
+    kept = []
+    for suffix, path in (('', normal_path), ('-og', og_path)):
+        if path is None:
+            kept.append(None)
+            continue
+        copy = os.path.join(customResultDir, f'{name}{suffix}.jpg')
+        shutil.copyfile(path, copy)
+        kept.append(copy)
+    custom_results.put(params, (shop_date, *kept))
+
+
+def clear_custom_results():
+    # Same as clear_og_renders, custom_results starts out empty.
+    shutil.rmtree(customResultDir, ignore_errors=True)
+
+
+def custom_result(params):
+    # (date, normal path, og path or None) of a finished custom render with the same shop hash
+    # and parameters, if its files are still on disk.
+    result = custom_results.get(params)
+    if result and all(os.path.exists(path) for path in result[1:] if path):
+        return result
+    return None
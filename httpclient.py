@@ -0,0 +1,129 @@
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+
+from logs import get_logger
+
+# =========== #
+httpConnectionLimit = 100  # Open connections across all hosts
+httpConnectionLimitPerHost = 16  # Open connections to a single host (the image CDN mostly)
+httpKeepAlive = 30  # Seconds an idle connection is kept around
+httpDnsCacheTtl = 300  # Seconds a DNS lookup is reused
+httpAttemptTimeout = 20  # Seconds a single attempt may take
+httpDeadline = 60  # Seconds a request may take including every retry
+httpRetries = 3  # Extra attempts on connection errors, timeouts and 429/5xx
+httpRetryBaseDelay = 0.5  # Seconds, doubled each retry with full jitter
+downloadConcurrency = 16  # Image downloads in flight at once
+# =========== #
+
+log = get_logger('http')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HttpResponse:
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class HttpClient:
+    # One pooled aiohttp session for the whole app, created and closed by the FastAPI lifespan.
+
+    def __init__(self):
+        self.session = None
+        self.download_slots = asyncio.Semaphore(downloadConcurrency)
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.bytes = 0
+
+    async def start(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=httpConnectionLimit,
+                limit_per_host=httpConnectionLimitPerHost,
+                keepalive_timeout=httpKeepAlive,
+                ttl_dns_cache=httpDnsCacheTtl,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=httpAttemptTimeout),
+            )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def fetch(self, url, headers=None, deadline=httpDeadline):
+        await self.start()
+        try:
+            return await asyncio.wait_for(self._fetch_with_retries(url, headers), deadline)
+        except Exception:
+            self.failures += 1
+            raise
+
+    async def download(self, url, headers=None):
+        # Same as fetch, but limited to downloadConcurrency at once so a big shop doesn't burst the CDN.
+        async with self.download_slots:
+            return await self.fetch(url, headers=headers)
+
+    async def _fetch_with_retries(self, url, headers):
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                self.requests += 1
+                async with self.session.get(url, headers=headers) as resp:
+                    body = await resp.read()
+                self.bytes += len(body)
+                if resp.status not in RETRY_STATUSES or attempt >= httpRetries:
+                    return HttpResponse(resp.status, resp.headers, body)
+                retry_after = resp.headers.get('Retry-After')
+                log.info("Retrying request", extra={'url': url, 'status': resp.status})
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= httpRetries:
+                    raise
+                log.info("Retrying request", extra={'url': url, 'error': repr(e)})
+
+            delay = random.uniform(0, httpRetryBaseDelay * 2 ** attempt)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {'requests': self.requests, 'retries': self.retries, 'failures': self.failures, 'bytes': self.bytes, 'time': time.monotonic()}
+
+    def collect(self):
+        # For metrics.register_collector
+        return [
+            ('http_client_requests_total', 'counter', 'Upstream HTTP attempts.', [({}, self.requests)]),
+            ('http_client_retries_total', 'counter', 'Upstream HTTP retries.', [({}, self.retries)]),
+            ('http_client_failures_total', 'counter', 'Upstream requests that failed after every retry.', [({}, self.failures)]),
+            ('http_client_bytes_total', 'counter', 'Upstream response bytes received.', [({}, self.bytes)]),
+        ]
+
+    def report(self, before, label):
+        after = self.stats()
+        elapsed = max(after['time'] - before['time'], 1e-9)
+        size = after['bytes'] - before['bytes']
+        log.info(label, extra={
+            'requests': after['requests'] - before['requests'],
+            'retries': after['retries'] - before['retries'],
+            'failures': after['failures'] - before['failures'],
+            'mb': round(size / 1e6, 2),
+            'seconds': round(elapsed, 2),
+            'mb_per_second': round(size / 1e6 / elapsed, 2),
+        })
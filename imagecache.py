@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import hashlib
+from email.utils import formatdate
+
+import aiofiles
+
+from logs import get_logger
+
+# =========== #
+imageCacheDir = 'imagecache'  # Where raw downloads are kept between runs
+imageCacheMaxBytes = 1024 * 1024 * 1024  # Evict least recently used images above this size (1 GB)
+# =========== #
+
+log = get_logger('imagecache')
+
+
+class ImageCache:
+    # Raw cosmetic images, stored once per content digest and looked up by source url.
+    # Each url remembers its ETag / Last-Modified so later runs can revalidate with a 304
+    # instead of downloading the image again.
+
+    def __init__(self, directory=imageCacheDir, max_bytes=imageCacheMaxBytes):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.index_path = os.path.join(directory, 'index.json')
+        self.max_bytes = max_bytes
+        self.index = None
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def load(self):
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning("Could not read index, starting empty", extra={'error': str(e)})
+
+    def save(self):
+        if self.index is None:
+            return
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def path_for(self, digest):
+        return os.path.join(self.objects_dir, f'{digest}.png')
+
+    def lookup(self, url):
+        if self.index is None:
+            self.load()
+        entry = self.index.get(url)
+        if entry and not os.path.exists(self.path_for(entry['digest'])):
+            del self.index[url]
+            return None
+        return entry
+
+    async def fetch(self, client, url):
+        entry = self.lookup(url)
+
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = await client.download(url, headers=headers)
+        except Exception:
+            self.failures += 1
+            raise
+        if response.status == 304 and entry:
+            entry['last_used'] = time.time()
+            self.hits += 1
+            return self.path_for(entry['digest'])
+
+        if response.status != 200:
+            self.failures += 1
+            log.warning("Download failed", extra={'url': url, 'status': response.status})
+            return None
+
+        data = response.body
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.path_for(digest)
+        if not os.path.exists(path):
+            tmp_path = f'{path}.{hashlib.sha1(url.encode()).hexdigest()[:8]}.tmp'
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                await f.write(data)
+            os.replace(tmp_path, path)
+
+        self.index[url] = {
+            'digest': digest,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified') or formatdate(usegmt=True),
+            'size': len(data),
+            'last_used': time.time(),
+        }
+        self.misses += 1
+        return path
+
+    def collect(self):
+        # For metrics.register_collector
+        return [
+            ('image_downloads_total', 'counter', 'Image fetches by outcome (hit is a 304 revalidation).', [
+                ({'result': 'hit'}, self.hits),
+                ({'result': 'miss'}, self.misses),
+                ({'result': 'failure'}, self.failures),
+            ]),
+        ]
+
+    def evict(self):
+        if self.index is None:
+            return
+
+        # Several urls can point at the same file, so account per digest.
+        digests = {}
+        for entry in self.index.values():
+            size, last_used = digests.get(entry['digest'], (entry['size'], 0))
+            digests[entry['digest']] = (size, max(last_used, entry['last_used']))
+
+        total = sum(size for size, _ in digests.values())
+        if total <= self.max_bytes:
+            return
+
+        evicted = set()
+        for digest, (size, _) in sorted(digests.items(), key=lambda d: d[1][1]):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self.path_for(digest))
+            except FileNotFoundError:
+                pass
+            evicted.add(digest)
+            total -= size
+
+        self.index = {url: entry for url, entry in self.index.items() if entry['digest'] not in evicted}
+        log.info("Evicted images", extra={'evicted': len(evicted), 'bytes': total})
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+import shutil
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+from logs import get_logger
+import metrics
+
+# =========== #
+maxConcurrentJobs = 2  # Generation jobs allowed to run at the same time
+maxBackgroundJobs = 1  # Housekeeping after a new shop is out (variants, cards), in its own queue so it never holds up the jobs requests wait on
+jobWorkDir = 'work'  # Each job gets its own folder in here while it runs
+jobHistorySize = 200  # Finished jobs kept around for /api/v1/jobs/{id}
+jobRecordDir = 'work/jobs'  # Every job's state as JSON too, so any worker can answer /api/v1/jobs/{id}
+jobRecordMaxAge = 24 * 60 * 60  # Seconds before records of jobs no worker remembers are deleted
+# =========== #
+
+log = get_logger('jobs')
+
+stage_seconds = metrics.Histogram('stage_seconds', 'Time spent in each generation stage.', ['stage'])
+
+
+class Job:
+    __slots__ = ('id', 'kind', 'key', 'status', 'created', 'started', 'finished',
+                 'stages', 'active', 'result', 'error', 'workdir', 'done', 'aliases')
+
+    def __init__(self, kind, key, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.stages = []
+        self.active = []  # Stages running right now, concurrent ones included
+        self.result = None
+        self.error = None
+        self.workdir = os.path.join(jobWorkDir, self.id)
+        self.done = asyncio.Event()
+        self.aliases = []  # Ids other workers handed out for this job (see leader.request)
+
+    @property
+    def stage_name(self):
+        return self.active[-1] if self.active else None
+
+    @contextmanager
+    def stage(self, name):
+        self.active.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append({'stage': name, 'seconds': round(time.perf_counter() - start, 3)})
+            self.active.remove(name)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'stage': self.stage_name,
+            'stages': self.stages,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+@contextmanager
+def job_stage(job, name):
+    # Times a pipeline stage into stage_seconds, and into the job when it runs inside one.
+    with stage_seconds.time(stage=name), (job.stage(name) if job is not None else nullcontext()):
+        yield
+
+
+class JobQueue:
+    # Runs generation in the background. Submitting work whose key matches a job that is still
+    # queued or running returns that job instead of starting a second one.
+
+    def __init__(self, concurrency=maxConcurrentJobs):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.jobs = OrderedDict()
+        self.inflight = {}
+        self.tasks = set()
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def submit(self, kind, key, func, job_id=None):
+        # func is an async callable taking the Job, its return value becomes job.result.
+        # job_id is for work another worker already promised an id for.
+        job = self.inflight.get(key)
+        if job is not None:
+            if job_id and job_id != job.id:
+                job.aliases.append(job_id)
+                write_record(job)
+            return job
+
+        job = Job(kind, key, job_id)
+        self.inflight[key] = job
+        self.jobs[job.id] = job
+        while len(self.jobs) > jobHistorySize:
+            remove_records(self.jobs.popitem(last=False)[1])
+        write_record(job)
+
+        task = asyncio.create_task(self._run(job, func))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return job
+
+    async def _run(self, job, func):
+        try:
+            async with self.slots:
+                job.status = 'running'
+                job.started = time.time()
+                write_record(job)
+                os.makedirs(job.workdir, exist_ok=True)
+                job.result = await func(job)
+                job.status = 'done'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            log.error("Job failed", extra={'kind': job.kind, 'job': job.id, 'error': str(e)})
+        finally:
+            job.finished = time.time()
+            shutil.rmtree(job.workdir, ignore_errors=True)
+            self.inflight.pop(job.key, None)
+            write_record(job)
+            job.done.set()
+
+    async def shutdown(self):
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def record_path(job_id):
+    return os.path.join(jobRecordDir, f'{job_id}.json')
+
+
+def write_record(job):
+    try:
+        os.makedirs(jobRecordDir, exist_ok=True)
+        body = json.dumps(job.to_dict(), default=str)
+        for job_id in [job.id] + job.aliases:
+            tmp_path = f'{record_path(job_id)}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(body)
+            os.replace(tmp_path, record_path(job_id))
+    except OSError as e:
+        log.warning("Failed to record job", extra={'job': job.id, 'error': str(e)})
+
+
+def read_record(job_id):
+    if not job_id.isalnum():
+        return None
+    try:
+        with open(record_path(job_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_records(job):
+    for job_id in [job.id] + job.aliases:
+        try:
+            os.remove(record_path(job_id))
+        except FileNotFoundError:
+            pass
+
+
+def prune_records():
+    # Records of workers that went away before their history rolled over.
+    if not os.path.isdir(jobRecordDir):
+        return
+    cutoff = time.time() - jobRecordMaxAge
+    for entry in os.scandir(jobRecordDir):
+        if entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
@@ -0,0 +1,148 @@
+import asyncio
+import fcntl
+import json
+import os
+import uuid
+
+import jobs
+from logs import get_logger
+
+# =========== #
+leaderLockPath = 'work/leader.lock'  # The worker holding an flock on this file polls and generates
+leaderRetryInterval = 2  # Seconds between a follower's attempts to take the lease over
+requestDir = 'work/requests'  # Work the other workers hand to the leader, one file per request
+watchInterval = 1  # Seconds between checks of the files shared state lives in (one stat() each)
+requestTimeout = 300  # Seconds a worker waits on the leader for a job it forwarded and needs the result of
+# =========== #
+
+log = get_logger('leader')
+
+# Several uvicorn workers serve, exactly one of them also polls upstream and generates. The lease
+# is an flock, which the kernel drops the moment its holder exits or crashes, so failover needs no
+# heartbeat: the next follower to retry just gets it. Everything else is shared through files the
+# leader already writes (hash.json, fngg.json, the job records in jobs.py), watched with stat().
+
+
+class LeaderLease:
+    def __init__(self, path=leaderLockPath):
+        self.path = path
+        self.fd = None
+
+    @property
+    def held(self):
+        return self.fd is not None
+
+    def try_acquire(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f'{os.getpid()}\n'.encode())  # For whoever wonders which worker leads
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    async def run(self, on_elected):
+        # Follows until the lease is free, then leads: on_elected() is the leader's background work.
+        while not self.try_acquire():
+            await asyncio.sleep(leaderRetryInterval)
+        log.info("Took the leader lease", extra={'pid': os.getpid()})
+        try:
+            await on_elected()
+        finally:
+            self.release()
+
+
+class FileWatcher:
+    # Calls on_change(path) when one of paths is written or replaced.
+
+    def __init__(self, paths, interval=watchInterval):
+        self.paths = list(paths)
+        self.interval = interval
+
+    def signature(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    async def run(self, on_change):
+        seen = {path: self.signature(path) for path in self.paths}
+        while True:
+            await asyncio.sleep(self.interval)
+            for path in self.paths:
+                signature = self.signature(path)
+                if signature != seen[path]:
+                    seen[path] = signature
+                    try:
+                        await on_change(path)
+                    except Exception as e:
+                        log.warning("Failed to pick up a shared file", extra={'path': path, 'error': str(e)})
+
+
+def request(kind, params=None):
+    # Asks the leader to run a job of this kind, returns the id it will run (or join it) under.
+    os.makedirs(requestDir, exist_ok=True)
+    job_id = uuid.uuid4().hex
+    tmp_path = os.path.join(requestDir, f'.{job_id}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'kind': kind, 'params': params or {}}, f)
+    os.replace(tmp_path, os.path.join(requestDir, job_id))
+    return job_id
+
+
+def take_requests():
+    # [(job id, kind, params)] of every pending request, each handed out once.
+    if not os.path.isdir(requestDir):
+        return []
+    requests = []
+    for entry in os.scandir(requestDir):
+        if entry.name.startswith('.'):
+            continue
+        try:
+            with open(entry.path, 'r') as f:
+                body = json.load(f)
+            os.remove(entry.path)
+        except FileNotFoundError:
+            continue
+        except ValueError:
+            log.warning("Dropped an unreadable request", extra={'job': entry.name})
+            os.remove(entry.path)
+            continue
+        requests.append((entry.name, body['kind'], body['params']))
+    return requests
+
+
+async def serve_requests(handlers, interval=watchInterval):
+    # Leader side of request(): handlers maps a kind to a function taking the job id and the params.
+    while True:
+        for job_id, kind, params in await asyncio.to_thread(take_requests):
+            handler = handlers.get(kind)
+            if handler is None:
+                log.warning("Unknown request", extra={'kind': kind, 'job': job_id})
+                continue
+            try:
+                handler(job_id, params)
+            except Exception as e:
+                log.warning("Failed to take a request", extra={'kind': kind, 'job': job_id, 'error': str(e)})
+        await asyncio.sleep(interval)
+
+
+async def wait_for(job_id, timeout=requestTimeout, interval=watchInterval):
+    # The job record of a forwarded request once the leader finished it, None if it didn't in time.
+    deadline = asyncio.get_running_loop().time() + timeout
+    while asyncio.get_running_loop().time() < deadline:
+        record = await asyncio.to_thread(jobs.read_record, job_id)
+        if record is not None and record['status'] in ('done', 'failed'):
+            return record
+        await asyncio.sleep(interval)
+    return None
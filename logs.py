@@ -0,0 +1,53 @@
+import json
+import logging
+import sys
+import time
+
+# =========== #
+logFormat = 'json'  # 'json' for one JSON object per line, 'text' for reading in a terminal
+logLevel = 'INFO'
+# =========== #
+
+# Attributes every LogRecord has, anything else on a record came in through extra= and is logged as a field.
+RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+def record_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in RESERVED}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(record_fields(record))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.created))} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        fields = record_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+def get_logger(name):
+    # Loggers live under "shopapi" with their own handler, so uvicorn's logging config leaves them alone.
+    root = logging.getLogger('shopapi')
+    if not root.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JsonFormatter() if logFormat == 'json' else TextFormatter())
+        root.addHandler(handler)
+        root.setLevel(logLevel)
+        root.propagate = False
+    return logging.getLogger(f'shopapi.{name}')
@@ -1,22 +1,40 @@
 from fastapi import FastAPI, BackgroundTasks, Query, Request, HTTPException, Depends
 import asyncio
-import aiohttp
 import aiofiles
-from PIL import Image, ImageFont, ImageDraw
-from datetime import datetime
+from PIL import Image
 import os
 import time
 import shutil
-from functools import partial
-from concurrent.futures import ProcessPoolExecutor
 import json
-import glob
+from typing import List, Optional
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
-
-from merger import merger
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, Response
+
+from merger import merger, compose_grid, GridBuilder
+from imagecache import ImageCache
+from httpclient import HttpClient
+import fngg
+from shopstate import ShopState
+from events import EventBroadcaster
+import catalog
+from jobs import JobQueue, job_stage
+import jobs
+import leader
+from leader import LeaderLease, FileWatcher
+from shoppoller import ShopPoller
+import gridcache
+from webcache import cached_response, ShopStaticFiles, immutableCacheControl
+import render
+import variants
+import snapshotstore
+import tiles
+import cardfiles
+from shopitems import ItemIndex
+from shopdata import normalize_shop
+from logs import get_logger
+import metrics
 
 # Global variables and configurations
 itemShopFont = 'assets/BurbankBigRegular-BlackItalic.otf'  # the font you wish to use
@@ -33,6 +51,23 @@ ogTitleText = "OG Items"  # Title for the OG items image
 showDateNormal = True  # Should the date be shown in the normal image?
 showDateOg = True  # Should the date be shown in the OG items image?
 
+image_cache = ImageCache()  # Raw downloads, kept between runs (see imagecache.py)
+http_client = HttpClient()  # Shared, pooled HTTP client (see httpclient.py)
+fngg_index = fngg.FnggIndex()  # fortnite.gg ids, refreshed in the background (see fngg.py)
+shop_events = EventBroadcaster()  # Pushes new shops to /api/v1/events clients (see events.py)
+job_queue = JobQueue()  # Regeneration and custom shops run here (see jobs.py)
+background_queue = JobQueue(jobs.maxBackgroundJobs)  # Post-publish variants and cards
+shop_poller = ShopPoller()  # Watches /v2/shop for a new hash (see shoppoller.py)
+leader_lease = LeaderLease()  # Only the worker holding it polls and generates (see leader.py)
+shared_files = FileWatcher([hash_file, fngg_index.path])  # How the other workers hear about it
+
+log = get_logger('main')
+
+request_seconds = metrics.Histogram('http_request_duration_seconds', 'Time to handle a request, per endpoint.', ['method', 'route', 'status'], metrics.requestBuckets)
+card_cache_results = metrics.Counter('card_cache_total', 'Card renders served from the card cache (hit) or drawn (miss).', ['result'])
+metrics.register_collector(http_client.collect)
+metrics.register_collector(image_cache.collect)
+
 def load_hash():
     global hash_data
     if os.path.exists(hash_file):
@@ -42,183 +77,294 @@ def load_hash():
         hash_data = {"hash": ""}
 
 def save_hash():
-    with open(hash_file, 'w') as f:
+    # Replaced whole, the other workers read it as soon as it changes.
+    with open(f'{hash_file}.tmp', 'w') as f:
         json.dump(hash_data, f)
+    os.replace(f'{hash_file}.tmp', hash_file)
+
+def publish_hash(new_hash):
+    # Called once a shop is fully generated, so / and /api/v1/info never point at images that don't exist yet.
+    hash_data['hash'] = new_hash
+    save_hash()
+    show_shop(new_hash)
+
+def show_shop(new_hash):
+    global shop_state
+    shop_state = ShopState(new_hash, templates)
+    shop_events.publish("shop", shop_state.info)
+
+async def lead():
+    # Background work of the leader only, every other worker just serves.
+    await asyncio.to_thread(catalog.bootstrap)
+    await asyncio.to_thread(gridcache.clear_og_renders)
+    await asyncio.to_thread(gridcache.clear_custom_results)
+    await asyncio.to_thread(jobs.prune_records)
+    await asyncio.to_thread(render.start_pool, overlayPath, itemShopFont)
+    await asyncio.gather(
+        check_and_update_shop(),
+        fngg_index.run(http_client),
+        leader.serve_requests({
+            'regen': lambda job_id, params: job_queue.submit('regen', ('regen',), regenerate_shop, job_id),
+            'custom': lambda job_id, params: submit_custom(params['customParams'], params['saveAs'], params['key'], job_id),
+            'og': lambda job_id, params: submit_og(params['hash'], params['threshold'], job_id),
+        }),
+    )
+
+async def on_shared_file(path):
+    # A new shop or fortnite.gg index written by the leader.
+    if path == hash_file:
+        await asyncio.to_thread(load_hash)
+        if hash_data.get('hash', '') != shop_state.hash:
+            log.info("Picked up a new shop from the leader", extra={'hash': hash_data.get('hash', '')})
+            show_shop(hash_data.get('hash', ''))
+    elif path == fngg_index.path and not leader_lease.held:
+        await asyncio.to_thread(fngg_index.load)
 
 async def check_and_update_shop():
-    while True:
-        await check_shop_update()
-        await asyncio.sleep(900)  # Wait for 15 minutes
+    await shop_poller.run(http_client, check_shop_update)
 
-async def check_shop_update():
-    load_hash()
+async def check_shop_update(shop_data, body=None):
+    if body is not None:
+        await store_snapshot(body, shop_data)
     current_hash = hash_data.get('hash', '')
-    print(f"Current saved hash: {current_hash}")
-
-    async with aiohttp.ClientSession() as session:
-        async with session.get('https://fortnite-api.com/v2/shop') as resp:
-            if resp.status != 200:
-                print("Failed to fetch shop data.")
-                return
-            data = await resp.json()
-            shop_data = data['data']
-            new_hash = shop_data['hash']
-
-            if new_hash != current_hash:
-                print("Hash has changed, regenerating shop images.")
-                hash_data['hash'] = new_hash
-                save_hash()
-
-                await genshop(session, shop_data, new_hash)
-                if checkForOgItems:
-                    await ogitems(session, shop_data, new_hash)
-                else:
-                    print("Og items is disabled.")
-
-                move_old_images_to_archive(new_hash)
-            else:
-                print("Hash has not changed.")
+    new_hash = shop_data['hash']
+
+    if new_hash != current_hash:
+        log.info("Hash has changed, regenerating shop images", extra={'old_hash': current_hash, 'hash': new_hash})
+        job = job_queue.submit('regen', ('regen',), lambda job: regenerate_shop(job, shop_data))
+        await job.done.wait()
+        if job.status != 'done':
+            raise RuntimeError(f"Regenerating shop {new_hash} failed: {job.error}")
+        return True
+    log.info("Hash has not changed", extra={'hash': current_hash})
+    return False
 
-def move_old_images_to_archive(new_hash):
-    os.makedirs('shops/archive', exist_ok=True)
-    os.makedirs('shops/archive/og', exist_ok=True)
+async def regenerate_shop(job, shop_data=None):
+    if shop_data is None:
+        with job_stage(job, 'fetch'):
+            shop_data = await fetch_shop('https://fortnite-api.com/v2/shop?responseFlags=0x7')
+        if shop_data is None:
+            raise RuntimeError("Failed to fetch shop data.")
+    new_hash = shop_data['hash']
+
+    with job_stage(job, 'parse'):
+        currentdate, entries = normalize_shop(shop_data)
+    cards = await generate_shop(http_client, shop_data, new_hash, entries, job=job)
+
+    publish_hash(new_hash)
+    move_old_images_to_archive(new_hash)
+    tiles.prune(new_hash)
+    if variants.eagerVariants:
+        sources = [f'shops/shop-{new_hash}.jpg', f'shops/og/og-{new_hash}.jpg']
+        background_queue.submit('variants', ('variants', new_hash), lambda job: asyncio.to_thread(variants.generate_all, sources))
+    if cardfiles.cardOutput:
+        background_queue.submit('cards', ('cards', new_hash), lambda job: save_cards(job, new_hash, cards))
+    return {"hash": new_hash}
+
+async def create_custom_shop(job, custom_params, saveAs, key):
+    normal_path = os.path.join('shops', 'custom', key, f'{saveAs}.jpg')
+    og_path = os.path.join('shops', 'custom', key, f'og-{saveAs}.jpg')
+
+    params = (shop_state.hash, *custom_params.values())
+    cached = gridcache.custom_result(params)
+    if cached:
+        with job_stage(job, 'copy'):
+            await asyncio.to_thread(copy_custom_result, cached, normal_path, og_path, saveAs, key)
+        return {"hash": shop_state.hash, "cached": True}
+
+    rendered = gridcache.rendered_shops.get(shop_state.hash)
+    if rendered is not None and rendered.cards is not None:
+        # The current shop is already rendered, only the titles and the OG subset change.
+        shop_data, entries = rendered.shop_data, rendered.entries
+    else:
+        shop_data = await current_shop(job)
+        with job_stage(job, 'parse'):
+            currentdate, entries = normalize_shop(shop_data)
+        with job_stage(job, 'download'):
+            await download_entries(http_client, entries, og_threshold=custom_params['ogThreshold'] if checkForOgItems else None)
+    new_hash = shop_data['hash']
+
+    # Generate custom shop images
+    made_normal = await genshop(http_client, shop_data, new_hash, custom=True, custom_params=custom_params, saveAs=saveAs, key=key, entries=entries, job=job)
+    made_og = False
+    if checkForOgItems:
+        made_og = await ogitems(http_client, shop_data, new_hash, custom=True, custom_params=custom_params, saveAs=saveAs, key=key, entries=entries, job=job)
+    else:
+        log.info("Og items is disabled")
+
+    if not made_og:
+        await asyncio.to_thread(remove_custom_image, og_path)
+    if made_normal:
+        await asyncio.to_thread(
+            gridcache.keep_custom_result,
+            (new_hash, *custom_params.values()),
+            shop_data['date'][:10], normal_path, og_path if made_og else None
+        )
+    return {"hash": new_hash, "cached": False}
+
+def copy_custom_result(cached, normal_path, og_path, saveAs, key):
+    shop_date, cached_normal, cached_og = cached
+    os.makedirs(os.path.dirname(normal_path), exist_ok=True)
+    for src, dst in ((cached_normal, normal_path), (cached_og, og_path)):
+        if src is None:
+            remove_custom_image(dst)
+            continue
+        shutil.copyfile(src, dst)
+        with Image.open(dst) as img:
+            catalog.record(dst, 'custom', saveAs, shop_date, *img.size, key=key)
 
-    for filename in glob.glob('shops/shop-*.jpg'):
-        if new_hash not in filename:
-            shutil.move(filename, os.path.join('shops/archive', os.path.basename(filename)))
+def remove_custom_image(path):
+    # An OG image left over from an earlier request under the same name, when this one has none.
+    if os.path.exists(path):
+        os.remove(path)
+        catalog.forget(path)
 
-    for filename in glob.glob('shops/og/og-*.jpg'):
-        if new_hash not in filename:
-            shutil.move(filename, os.path.join('shops/archive/og', os.path.basename(filename)))
+async def fetch_shop(url):
+    try:
+        resp = await http_client.fetch(url)
+    except Exception as e:
+        log.warning("Failed to fetch shop data", extra={'url': url, 'error': str(e)})
+        return None
+    if resp.status != 200:
+        log.warning("Failed to fetch shop data", extra={'url': url, 'status': resp.status})
+        return None
+    shop_data = resp.json()['data']
+    await store_snapshot(resp.body, shop_data)
+    return shop_data
+
+async def store_snapshot(body, shop_data):
+    # Every shop seen goes into the snapshot store, but failing to store one never stops generation.
+    try:
+        await asyncio.to_thread(snapshotstore.add, body, shop_data)
+    except Exception as e:
+        log.warning("Failed to store shop snapshot", extra={'hash': shop_data.get('hash'), 'error': str(e)})
+
+async def current_shop(job):
+    # /v2/shop data of the published shop, from the snapshot store unless it isn't in there.
+    shop_data = None
+    if shop_state.hash:
+        with job_stage(job, 'load'):
+            shop_data = await asyncio.to_thread(snapshotstore.load, shop_state.hash)
+    if shop_data is None:
+        with job_stage(job, 'fetch'):
+            shop_data = await fetch_shop('https://fortnite-api.com/v2/shop?responseFlags=0x7')
+    if shop_data is None:
+        raise RuntimeError("Failed to fetch shop data.")
+    return shop_data
 
-async def genshop(session, shop_data, shop_hash, custom=False, custom_params=None, saveAs=None, key=None):
-    print("Generating the Fortnite Item Shop.")
+def move_old_images_to_archive(new_hash):
+    os.makedirs('shops/archive', exist_ok=True)
+    os.makedirs('shops/archive/og', exist_ok=True)
 
-    shutil.rmtree('cache', ignore_errors=True)
-    os.makedirs('cache', exist_ok=True)
+    for image in catalog.current_images(new_hash):
+        filename = os.path.join('shops', image['path'])
+        if not os.path.exists(filename):
+            catalog.forget(filename)
+            continue
+        folder = 'shops/archive/og' if image['kind'] == 'og' else 'shops/archive'
+        archived = os.path.join(folder, os.path.basename(filename))
+        shutil.move(filename, archived)
+        catalog.mark_archived(filename, archived)
+
+async def generate_shop(client, shop_data, shop_hash, entries, job=None):
+    # Both images of a regeneration from one streamed pass over the cards (see stream_cards), then
+    # merged side by side. genshop and ogitems only merge here, their cards are already in gridcache.
+    with job_stage(job, 'cards'):
+        streamed = await stream_cards(client, entries, og_threshold=ogThreshold if checkForOgItems else None, job=job)
+
+    rendered = gridcache.rendered_shop(shop_hash, shop_data, entries, fresh=True)
+    cards, grid = streamed['shop']
+    rendered.cards = in_merge_order(cards)
+    if grid is not None:
+        keep_grid(rendered, ('shop',), grid)
+    cards, grid = streamed['og']
+    rendered.og_cards.update(cards)
+    if grid is not None:
+        keep_grid(rendered, ('og', ogThreshold), grid)
+
+    merges = [genshop(client, shop_data, shop_hash, entries=entries, job=job, prepared=True)]
+    if checkForOgItems:
+        merges.append(ogitems(client, shop_data, shop_hash, entries=entries, job=job, prepared=True))
+    else:
+        log.info("Og items is disabled")
+    await asyncio.gather(*merges)
+    # Every card by filename, normal and OG, for save_cards.
+    return {**streamed['shop'][0], **streamed['og'][0]}
+
+async def save_cards(job, shop_hash, cards):
+    # Runs as its own job once the shop is published, it isn't worth holding the new shop back for.
+    with job_stage(job, 'save'):
+        saved = await asyncio.to_thread(cardfiles.save, shop_hash, cards)
+    if saved:
+        gridcache.item_indexes.pop(shop_hash, None)  # May have been built before the cards were there
+    return {"hash": shop_hash, "saved": saved is not None}
+
+async def genshop(client, shop_data, shop_hash, custom=False, custom_params=None, saveAs=None, key=None, entries=None, job=None, prepared=False):
+    log.info("Generating the Fortnite Item Shop", extra={'hash': shop_hash, 'custom': custom})
 
     start = time.time()
 
     currentdate = shop_data['date'][:10]
-    entries = shop_data['entries']
-    item_data_list = []
+    if entries is None:
+        entries = normalize_shop(shop_data)[1]
 
     if entries:
-        for entry in entries:
-            i = entry
-
-            url = None
-
-            tracks = i.get('tracks', None)
-
-            offertag = i.get('offerTag', {})
-            offerId = offertag.get('id', "")
-
-            brItemsfrfr = i.get('brItems', None)
-
-            if offerId == "sparksjamloop":
-                continue
-
-            if tracks:
-                continue
-
-            if not brItemsfrfr:
-                continue
-
-
-            new_display_asset = i.get('newDisplayAsset', {})
-            material_instances = new_display_asset.get('materialInstances', [])
-            if material_instances:
-                images = material_instances[0].get('images', {})
-                url = images.get('Background') or images.get('OfferImage')
-            else:
-                render_images = new_display_asset.get('renderImages', [])
-                if render_images:
-                    url = render_images[0].get('image')
-
-            if not url:
-                url = i['brItems'][0]['images']['icon']
-
-            last_seen = i['brItems'][0].get('shopHistory', [])
-            last_seen_date = last_seen[-2][:10] if len(last_seen) >= 2 else 'NEW!'
-            price = i['finalPrice']
-
-            if i.get('bundle'):
-                url = i['bundle']['image']
-                filename = f"zzz{i['bundle']['name']}"
-                name = i['bundle']['name']
-            else:
-                filename = i['brItems'][0]['id']
-                name = i['brItems'][0]['name']
-
-            if last_seen_date != 'NEW!':
-                diff_days = (datetime.strptime(currentdate, "%Y-%m-%d") - datetime.strptime(last_seen_date, "%Y-%m-%d")).days
-                diff = str(diff_days or 1)
-            else:
-                diff = 'NEW!'
-
-            item_data = {
-                'filename': filename,
-                'url': url,
-                'i': i,
-                'diff': diff,
-                'price': price,
-                'name': name,
-                'currentdate': currentdate,
-            }
-            item_data_list.append(item_data)
-
-        download_tasks = [download_image(session, item['url'], item['filename']) for item in item_data_list]
-        await asyncio.gather(*download_tasks)
-
-        overlay = Image.open(overlayPath).convert('RGBA')
-        process_partial = partial(process_item, overlay=overlay, font_path=itemShopFont)
-
-        with ProcessPoolExecutor() as executor:
-            loop = asyncio.get_running_loop()
-            tasks = [loop.run_in_executor(executor, process_partial, item_data) for item_data in item_data_list]
-            await asyncio.gather(*tasks)
-
-        print(f'Done generating "{len(item_data_list)}" items in the Featured section.')
-
-        print(f'\nGenerated {len(item_data_list)} items from the {currentdate} Item Shop.')
-
-        print('\nMerging images...')
+        rendered = gridcache.rendered_shop(shop_hash, shop_data, entries, fresh=not (custom or prepared))
+        grid = None
+
+        if (custom or prepared) and rendered.cards is not None:
+            # Cards don't depend on the custom parameters, only the title band does.
+            cards = rendered.cards
+            grid = rendered.grids.get(('shop',))
+            if grid is None and cards:
+                with job_stage(job, 'shop grid'):
+                    grid = keep_grid(rendered, ('shop',), await asyncio.to_thread(compose_grid, cards))
+        else:
+            with job_stage(job, 'shop download'):
+                await download_entries(client, entries)
+            render_tasks = [card_task(item) for item in entries if item.source]
+            with job_stage(job, 'shop render'):
+                cards = in_merge_order(await render_cards(render_tasks))
+            rendered.cards = cards
+
+        log.info("Generated cards", extra={'items': len(cards), 'date': currentdate})
+        if not cards:
+            log.info("No images to merge")
+            return False
         if custom and custom_params:
-            await asyncio.to_thread(
-                merger,
-                ogitems=False,
-                currentdate=currentdate,
-                shop_hash=shop_hash,
-                custom=custom,
-                title_text=custom_params['normTitle'],
-                showDate=custom_params['normalShowDate'],
-                saveAsName=saveAs,
-                key=key
-            )
+            title_text, show_date = custom_params['normTitle'], custom_params['normalShowDate']
         else:
-            await asyncio.to_thread(
+            title_text, show_date = normalTitleText, showDateNormal
+
+        with job_stage(job, 'shop merge'):
+            image = await asyncio.to_thread(
                 merger,
                 ogitems=False,
+                datas=cards,
                 currentdate=currentdate,
                 shop_hash=shop_hash,
                 custom=custom,
-                title_text=normalTitleText,
-                showDate=showDateNormal
+                title_text=title_text,
+                showDate=show_date,
+                saveAsName=saveAs,
+                key=key,
+                work_dir=job.workdir if job else None,
+                grid=grid,
+                job=job
             )
 
         end = time.time()
 
-        print(f"IMAGE GENERATING COMPLETE - Generated image in {round(end - start, 2)} seconds!")
-
-async def ogitems(session, shop_data, shop_hash, custom=False, custom_params=None, saveAs=None, key=None):
-    shutil.rmtree('ogcache', ignore_errors=True)
-    os.makedirs('ogcache', exist_ok=True)
+        log.info("Item shop image complete", extra={'hash': shop_hash, 'seconds': round(end - start, 2)})
+        return image is not None
+    return False
 
+async def ogitems(client, shop_data, shop_hash, custom=False, custom_params=None, saveAs=None, key=None, entries=None, job=None, prepared=False):
     start = time.time()
 
     currentdate = shop_data['date'][:10]
-    entries = shop_data['entries']
+    if entries is None:
+        entries = normalize_shop(shop_data)[1]
 
     threshold = ogThreshold
 
@@ -226,254 +372,429 @@ async def ogitems(session, shop_data, shop_hash, custom=False, custom_params=Non
         threshold = custom_params.get('ogThreshold', ogThreshold)
 
     if not entries:
-        print(f'No items found in the {currentdate} Item Shop.')
-        return
-
-    resultlist = []
-    for entry in entries:
-
-        i = entry
-
-        tracks = i.get('tracks', None)
+        log.info("No items found in the Item Shop", extra={'date': currentdate})
+        return False
 
-        offertag = i.get('offerTag', {})
-        offerId = offertag.get('id', "")
-
-        brItemsfrfr = i.get('brItems', None)
-
-        if offerId == "sparksjamloop":
-            continue
-
-        if tracks:
-            continue
-
-        if not brItemsfrfr:
-            continue
-
-
-        brItems = i['brItems'][0]
-
-        shophistory = i['brItems'][0].get('shopHistory', [])
-        lastseen_date = shophistory[-2][:10] if len(shophistory) >= 2 else currentdate
-        days_since_last_seen = (datetime.strptime(currentdate, "%Y-%m-%d") - datetime.strptime(lastseen_date, "%Y-%m-%d")).days
-        if days_since_last_seen >= threshold:
-            price = i['finalPrice']
-            resultlist.append({
-                "name": brItems['name'],
-                "id": brItems['id'],
-                "lastseen_days": str(days_since_last_seen),
-                "lastseen_date": lastseen_date,
-                "type": brItems['type']['displayValue'],
-                "price": price,
-                "item_data": brItems
-            })
+    resultlist = [entry for entry in entries if entry.og_days >= threshold]
 
     if not resultlist:
-        print('There are no rare items.')
-        return
-
-    print('Rare cosmetics have been found')
-    rarest_item = max(resultlist, key=lambda x: int(x['lastseen_days']))
-    print(f"The rarest item is the {rarest_item['name']} {rarest_item['type']}, which hasn't been seen in {rarest_item['lastseen_days']} days!")
-
-    print("Rare items:")
-    for item in resultlist:
-        print(f"- {item['name']} ({item['lastseen_days']} days)\n")
-
-    download_tasks = []
-    for item in resultlist:
-        filename = f"OG{item['id']}"
-        fpath = f'ogcache/{filename}.png'
-        if not os.path.exists(fpath):
-            itm = item['item_data']
-            url = None
-
-            new_display_asset = itm.get('newDisplayAsset', {})
-            material_instances = new_display_asset.get('materialInstances', [])
-            if material_instances:
-                images = material_instances[0].get('images', {})
-                url = images.get('Background') or images.get('OfferImage')
-            else:
-                render_images = new_display_asset.get('renderImages', [])
-                if render_images:
-                    url = render_images[0].get('image')
-
-            if not url:
-                url = itm['images']['icon']
-
-            if url:
-                download_tasks.append(download_image(session, url, filename, folder='ogcache'))
-
-    await asyncio.gather(*download_tasks)
-
-    overlay = Image.open(overlayPath).convert('RGBA')
-    process_partial = partial(process_og_item, overlay=overlay, font_path=itemShopFont)
-
-    with ProcessPoolExecutor() as executor:
-        loop = asyncio.get_running_loop()
-        tasks = [loop.run_in_executor(executor, process_partial, item) for item in resultlist]
-        await asyncio.gather(*tasks)
+        log.info("There are no rare items", extra={'threshold': threshold})
+        return False
+
+    rarest_item = max(resultlist, key=lambda x: x.og_days)
+    log.info("Rare cosmetics have been found", extra={
+        'items': len(resultlist),
+        'threshold': threshold,
+        'rarest': f"{rarest_item.item_name} {rarest_item.type}",
+        'rarest_days': rarest_item.og_days,
+        'rare_items': {item.item_name: item.og_days for item in resultlist},
+    })
+
+    rendered = gridcache.rendered_shop(shop_hash, shop_data, entries)
+    cards = await og_cards(client, rendered, resultlist, threshold, job)
+
+    grid = None
+    if custom or prepared:
+        grid = rendered.grids.get(('og', threshold))
+        if grid is None and cards:
+            with job_stage(job, 'og grid'):
+                grid = keep_grid(rendered, ('og', threshold), await asyncio.to_thread(compose_grid, cards))
 
     if custom and custom_params:
-        await asyncio.to_thread(
+        title_text, show_date = custom_params['ogTitle'], custom_params['ogShowDate']
+    else:
+        title_text, show_date = ogTitleText, showDateOg
+
+    with job_stage(job, 'og merge'):
+        image = await asyncio.to_thread(
             merger,
             ogitems=True,
+            datas=cards,
             currentdate=currentdate,
             shop_hash=shop_hash,
             custom=custom,
-            title_text=custom_params['ogTitle'],
-            showDate=custom_params['ogShowDate'],
+            title_text=title_text,
+            showDate=show_date,
             saveAsName=saveAs,
-            key=key
+            key=key,
+            work_dir=job.workdir if job else None,
+            grid=grid,
+            job=job
         )
-    else:
+    end = time.time()
+    log.info("OG items image complete", extra={'hash': shop_hash, 'seconds': round(end - start, 2)})
+    return image is not None
+
+async def og_cards(client, rendered, resultlist, threshold, job=None):
+    # OG cards are kept per shop, so another threshold only renders the cards it hasn't seen yet.
+    missing = [item for item in resultlist if f"OG{item.id}" not in rendered.og_cards]
+
+    if missing:
+        with job_stage(job, 'og download'):
+            await download_entries(client, missing, og_threshold=threshold, normal=False)
+
+        render_tasks = [og_card_task(item) for item in missing if item.og_source]
+        with job_stage(job, 'og render'):
+            rendered.og_cards.update(await render_cards(render_tasks))
+
+    return in_merge_order({
+        f"OG{item.id}": rendered.og_cards[f"OG{item.id}"]
+        for item in resultlist if f"OG{item.id}" in rendered.og_cards
+    })
+
+async def shop_snapshot(shop_hash):
+    # (date, entries) of a shop for /api/v1/og and /api/v1/shop/items, parsed from the snapshot store
+    # the first time it's asked for. The current shop is refetched if even the store doesn't have it.
+    snapshot = gridcache.snapshots.get(shop_hash)
+    if snapshot is None and (shop_hash == shop_state.hash or await asyncio.to_thread(snapshotstore.lookup, shop_hash)):
+        job = job_queue.submit('snapshot', ('snapshot', shop_hash), lambda job: load_snapshot(job, shop_hash))
+        await job.done.wait()
+        snapshot = gridcache.snapshots.get(shop_hash)
+    return snapshot
+
+async def load_snapshot(job, shop_hash):
+    with job_stage(job, 'load'):
+        shop_data = await asyncio.to_thread(snapshotstore.load, shop_hash)
+    if shop_data is None:
+        if not leader_lease.held:
+            raise RuntimeError(f"No snapshot of shop {shop_hash}.")  # Only the leader talks to upstream
+        shop_data = await current_shop(job)
+    with job_stage(job, 'parse'):
+        currentdate, entries = normalize_shop(shop_data)
+    gridcache.snapshots.put(shop_data['hash'], (shop_data['date'], entries))
+    return {"hash": shop_data['hash']}
+
+async def item_index(shop_hash):
+    # ItemIndex of a shop, built once per hash from its parsed snapshot.
+    index = gridcache.item_indexes.get(shop_hash)
+    if index is None:
+        snapshot = await shop_snapshot(shop_hash)
+        if snapshot is None:
+            return None
+        shop_date, entries = snapshot
+        cards = await asyncio.to_thread(cardfiles.saved, shop_hash)
+        index = ItemIndex(shop_hash, shop_date, entries, cards, ogThreshold if checkForOgItems else None)
+        if cards or not cardfiles.cardOutput:
+            # Without cards yet it's built again next time, the leader may still be saving them.
+            gridcache.item_indexes.put(shop_hash, index)
+    return index
+
+async def render_og_threshold(job, shop_hash, threshold):
+    # Merged OG image of an already parsed shop for any threshold, into gridcache.og_renders.
+    rendered = gridcache.shop_for(shop_hash)
+    if rendered is None:
+        # Asked for by another worker, which parsed the snapshot for itself.
+        await load_snapshot(job, shop_hash)
+        rendered = gridcache.shop_for(shop_hash)
+    if rendered is None:
+        raise RuntimeError(f"No snapshot of shop {shop_hash}.")
+
+    resultlist = [entry for entry in rendered.entries if entry.og_days >= threshold]
+    cards = await og_cards(http_client, rendered, resultlist, threshold, job)
+    if not cards:
+        return {"path": None}
+
+    grid = rendered.grids.get(('og', threshold))
+    if grid is None:
+        with job_stage(job, 'og grid'):
+            grid = keep_grid(rendered, ('og', threshold), await asyncio.to_thread(compose_grid, cards))
+
+    path = gridcache.og_render_path(shop_hash, threshold)
+    with job_stage(job, 'og merge'):
         await asyncio.to_thread(
             merger,
             ogitems=True,
-            currentdate=currentdate,
+            datas=cards,
+            save_as=path,
+            currentdate=rendered.date[:10],
             shop_hash=shop_hash,
-            custom=custom,
             title_text=ogTitleText,
-            showDate=showDateOg
+            showDate=showDateOg,
+            work_dir=job.workdir,
+            grid=grid,
+            job=job
         )
-    print(f"Saved in shops/og folder as 'og-{shop_hash}.jpg'.\n")
-
-    end = time.time()
-    print(f"OG ITEMS IMAGE GENERATING COMPLETE - Generated image in {round(end - start, 2)} seconds!")
-
-async def download_image(session, url, filename, folder='cache'):
-    try:
-        os.makedirs(folder, exist_ok=True)
-        fpath = f'{folder}/{filename}.png'
-        async with session.get(url) as response:
-            if response.status == 200:
-                async with aiofiles.open(fpath, 'wb') as f:
-                    await f.write(await response.read())
-                return True
-    except Exception as e:
-        print(f"Failed to download {url}: {e}")
-    return False
-
-def process_item(item_data, overlay, font_path):
-    filename = item_data['filename']
-    diff = item_data['diff']
-    price = item_data['price']
-    name = item_data['name']
-
-    try:
-        with Image.open(f'cache/{filename}.png') as background:
-            background = background.resize((512, 512))
-            img = Image.new("RGBA", (512, 512))
-            img.paste(background)
-
-            img.paste(overlay, (0, 0), overlay)
-
-            draw = ImageDraw.Draw(img)
-
-            font = ImageFont.truetype(font_path, 35)
-            draw.text((256, 420), name, font=font, fill='white', anchor='ms')
+    gridcache.og_renders.put((shop_hash, threshold), path)
+    return {"path": path}
 
-            diff_text = 'NEW!' if 'NEW!' in diff else f'LAST SEEN: {diff} day{"s" if diff != "1" else ""} ago'
-            font = ImageFont.truetype(font_path, 15)
-            draw.text((256, 450), diff_text, font=font, fill='white', anchor='ms')
+async def download_entries(client, entries, og_threshold=None, normal=True):
+    # Fetches each distinct url once, so an item in both the normal and OG sets only downloads once.
+    pending = {}
+    for entry in entries:
+        if normal and entry.source is None:
+            pending.setdefault(entry.url, []).append((entry, 'source'))
+        if og_threshold is not None and entry.og_source is None and entry.og_days >= og_threshold:
+            pending.setdefault(entry.og_url, []).append((entry, 'og_source'))
 
-            font = ImageFont.truetype(font_path, 40)
-            draw.text((256, 505), f'{price}', font=font, fill='white', anchor='ms')
+    if not pending:
+        return
 
-            img.save(f'cache/{filename}.png')
-    except Exception as e:
-        print(f"Error processing item {filename}: {e}")
+    before = client.stats()
+    sources = await asyncio.gather(*[download_image(client, url) for url in pending])
+    for targets, source in zip(pending.values(), sources):
+        for entry, attr in targets:
+            setattr(entry, attr, source)
+    client.report(before, f"Fetched {len(pending)} images")
+    image_cache.evict()
+    image_cache.save()
 
-def process_og_item(item, overlay, font_path):
-    filename = f"OG{item['id']}"
+async def download_image(client, url):
     try:
-        with Image.open(f'ogcache/{filename}.png') as background:
-            background = background.resize((512, 512))
-            img = Image.new("RGBA", (512, 512))
-            img.paste(background)
-
-            img.paste(overlay, (0, 0), overlay)
-
-            draw = ImageDraw.Draw(img)
-
-            font = ImageFont.truetype(font_path, 35)
-            draw.text((256, 420), item['name'], font=font, fill='white', anchor='ms')
-
-            last_seen_days = item['lastseen_days']
-            diff_text = f'LAST SEEN: {last_seen_days} day{"s" if last_seen_days != "1" else ""} ago'
-            font = ImageFont.truetype(font_path, 15)
-            draw.text((256, 450), diff_text, font=font, fill='white', anchor='ms')
-
-            price = item['price']
-            font = ImageFont.truetype(font_path, 40)
-            draw.text((256, 505), f'{price}', font=font, fill='white', anchor='ms')
-
-            img.save(f'ogcache/{filename}.png')
+        return await image_cache.fetch(client, url)
     except Exception as e:
-        print(f"Error processing OG item {filename}: {e}")
+        log.warning("Failed to download image", extra={'url': url, 'error': str(e)})
+    return None
+
+async def stream_cards(client, entries, og_threshold=None, job=None):
+    # download_entries + render_cards + compose_grid for the normal and OG cards at once, overlapped:
+    # each card goes to the render pool as soon as its image lands, and each grid row is composed
+    # as soon as its last card is back. Returns {'shop': (cards, grid), 'og': (cards, grid)} with
+    # cards by filename, grid being None if a card went missing (it no longer fits the layout).
+    await asyncio.to_thread(render.start_pool, overlayPath, itemShopFont)
+
+    # (image, filename) -> entries drawn as that card, the last one with a source wins like in render_cards.
+    candidates = {}
+    pending = {}
+    for entry in entries:
+        candidates.setdefault(('shop', entry.filename), []).append(entry)
+        if entry.source is None:
+            pending.setdefault(entry.url, []).append((entry, 'source'))
+        if og_threshold is not None and entry.og_days >= og_threshold:
+            candidates.setdefault(('og', f"OG{entry.id}"), []).append(entry)
+            if entry.og_source is None:
+                pending.setdefault(entry.og_url, []).append((entry, 'og_source'))
+
+    def card_of(entry, attr):
+        return ('shop', entry.filename) if attr == 'source' else ('og', f"OG{entry.id}")
+
+    remaining = dict.fromkeys(candidates, 0)  # Downloads each card still waits on
+    for targets in pending.values():
+        for entry, attr in targets:
+            remaining[card_of(entry, attr)] += 1
+
+    cards = {'shop': {}, 'og': {}}
+    builders = {}
+    positions = {}
+    for image in cards:
+        order = sorted((filename for kind, filename in candidates if kind == image), key=lambda f: f'{f}.png')
+        builders[image] = GridBuilder(len(order)) if order else None
+        positions.update(((image, filename), index) for index, filename in enumerate(order))
+
+    ready = []
+    renders = []
+
+    def card_ready(card):
+        image, filename = card
+        attr, make_task = ('source', card_task) if image == 'shop' else ('og_source', og_card_task)
+        entry = next((entry for entry in reversed(candidates[card]) if getattr(entry, attr)), None)
+        if entry is not None:
+            ready.append((card, make_task(entry)))
+
+    def submit(flush=False):
+        size = render.batch_size()
+        while ready and (flush or len(ready) >= size):
+            batch, ready[:] = ready[:size], ready[size:]
+            for future in render.submit_all([task for _, task in batch]):
+                renders.append(asyncio.create_task(collect(future, [card for card, _ in batch])))
+
+    async def collect(future, batch):
+        results = unpack_cards(await asyncio.wrap_future(future))
+        rows = []
+        for image, filename in batch:
+            if filename not in results:
+                continue
+            cards[image][filename] = results[filename]
+            y = builders[image].add(positions[(image, filename)], results[filename])
+            if y is not None:
+                rows.append(asyncio.to_thread(builders[image].compose_row, y))
+        await asyncio.gather(*rows)
+
+    async def fetch(url, targets):
+        source = await download_image(client, url)
+        for entry, attr in targets:
+            setattr(entry, attr, source)
+            card = card_of(entry, attr)
+            remaining[card] -= 1
+            if remaining[card] == 0:
+                card_ready(card)
+        submit()
+
+    for card, count in remaining.items():
+        if count == 0:
+            card_ready(card)
+    submit()
+
+    before = client.stats()
+    with job_stage(job, 'download'):
+        await asyncio.gather(*[fetch(url, targets) for url, targets in pending.items()])
+    submit(flush=True)
+    if pending:
+        client.report(before, f"Fetched {len(pending)} images")
+        image_cache.evict()
+        image_cache.save()
+
+    # Only what is left to render once the last image is in.
+    with job_stage(job, 'render'):
+        await asyncio.gather(*renders)
+    render.card_cache.evict()
+
+    streamed = {}
+    for image, builder in builders.items():
+        grid = builder.grid if builder is not None and builder.complete else None
+        streamed[image] = (cards[image], grid)
+    return streamed
+
+async def render_cards(render_tasks):
+    await asyncio.to_thread(render.start_pool, overlayPath, itemShopFont)
+    batches = await asyncio.gather(*[asyncio.wrap_future(future) for future in render.submit_all(render_tasks)])
+    render.card_cache.evict()
+    return unpack_cards([result for batch in batches for result in batch])
+
+def unpack_cards(results):
+    # Workers hand back (filename, raw RGBA bytes, from card cache), or None for a card that failed.
+    results = [result for result in results if result]
+    hits = sum(1 for _, _, cached in results if cached)
+    card_cache_results.inc(hits, result='hit')
+    card_cache_results.inc(len(results) - hits, result='miss')
+    return {filename: Image.frombytes('RGBA', (512, 512), data) for filename, data, _ in results}
+
+def card_task(entry):
+    return (entry.filename, entry.source, entry.name, render.last_seen_text(entry.diff), entry.price)
+
+def og_card_task(entry):
+    return (f"OG{entry.id}", entry.og_source, entry.item_name, render.last_seen_text(str(entry.og_days)), entry.price)
+
+def keep_grid(rendered, key, grid):
+    # Other OG thresholds are composed for their one render and dropped, a grid is hundreds of MB.
+    if key == ('shop',) or key == ('og', ogThreshold):
+        rendered.grids[key] = grid
+    return grid
+
+def in_merge_order(cards):
+    # Keeps the old "sorted cache/ listing" order of the merged image.
+    return [cards[filename] for filename in sorted(cards, key=lambda f: f'{f}.png')]
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup code
-    task = asyncio.create_task(check_and_update_shop())
+    global shop_state
+    load_hash()
+    shop_state = ShopState(hash_data.get('hash', ''), templates)
+    await asyncio.to_thread(fngg_index.load)
+    await http_client.start()
+    tasks = [
+        asyncio.create_task(leader_lease.run(lead)),
+        asyncio.create_task(shared_files.run(on_shared_file)),
+    ]
     yield
     # Shutdown code
-    task.cancel()
-    try:
-        await task
-    except asyncio.CancelledError:
-        pass
+    shop_events.close()
+    await job_queue.shutdown()
+    await background_queue.shutdown()
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await asyncio.to_thread(render.shutdown_pool)
+    await http_client.close()
 
 app = FastAPI(lifespan=lifespan)
 
-app.mount("/shops", StaticFiles(directory="shops"), name="shops")
+app.mount("/shops", ShopStaticFiles(directory="shops"), name="shops")
 
-app.mount("/shops/og", StaticFiles(directory="shops/og"), name="shops/og")
+app.mount("/shops/og", ShopStaticFiles(directory="shops/og"), name="shops/og")
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 templates = Jinja2Templates(directory="templates")
 
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Labelled by route template (or mount), never the raw path, to keep the label set small.
+        route = request.scope.get('route')
+        route = getattr(route, 'path', None) or request.scope.get('root_path') or 'unmatched'
+        request_seconds.observe(time.perf_counter() - start, method=request.method, route=route, status=status)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+shop_state = ShopState(hash_data['hash'], templates)  # Replaced whole by publish_hash
+
 @app.get("/", response_class=HTMLResponse, include_in_schema=False)
 async def read_root(request: Request):
-    load_hash()
-    current_hash = hash_data.get('hash', '')
-    return templates.TemplateResponse("index.html", {"request": request, "hash": current_hash})
+    state = shop_state
+    return cached_response(request, state.page_body, state.page_etag, "text/html")
 
 @app.get("/api/v1/info")
-async def get_info():
-    load_hash()
-    current_hash = hash_data.get('hash', '')
-
-    normal_shop_link = f"/shops/shop-{current_hash}.jpg"
-    og_shop_link = f"/shops/og/og-{current_hash}.jpg"
-
-    return {
-        "hash": current_hash,
-        "normalShopLink": normal_shop_link,
-        "ogShopLink": og_shop_link
-    }
+async def get_info(request: Request):
+    state = shop_state
+    return cached_response(request, state.info_body, state.info_etag, "application/json")
+
+@app.get("/api/v1/events")
+async def shop_event_stream(request: Request, lastEventId: Optional[int] = Query(default=None)):
+    # Server-Sent Events, one "shop" event per newly generated shop. Reconnecting clients
+    # send Last-Event-ID (or ?lastEventId=) to get anything they missed.
+    last_event_id = request.headers.get('last-event-id')
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else lastEventId
+    return StreamingResponse(
+        shop_events.stream(last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Dependency to check a paging cursor, a bad one is the client's mistake
+def check_cursor(cursor: Optional[str] = Query(default=None)):
+    if cursor:
+        try:
+            catalog.decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return cursor
 
 @app.get("/api/v1/archive")
-async def get_archive():
+async def get_archive(
+    limit: int = Query(default=100, ge=1, le=1000),
+    cursor: Optional[str] = Depends(check_cursor),
+    since: Optional[str] = Query(default=None, description="YYYY-MM-DD"),
+    until: Optional[str] = Query(default=None, description="YYYY-MM-DD")
+):
+    # Newest first. When there is more, the X-Next-Cursor header holds the cursor for the next page.
+    rows, next_cursor = await asyncio.to_thread(catalog.archive_page, limit, cursor, since, until)
     archive_data = {}
-    # Get all shop images in shops/ and shops/archive/
-    shop_files = glob.glob('shops/archive/shop-*.jpg')
-    og_files = glob.glob('shops/archive/og/og-*.jpg')
-
-    for filepath in shop_files:
-        filename = os.path.basename(filepath)
-        hash_part = filename.split('-')[1].split('.')[0]
-        archive_data.setdefault(hash_part, {})
-        archive_data[hash_part]['normalShopLink'] = f"/shops/archive/{filename}"
-
-    for filepath in og_files:
-        filename = os.path.basename(filepath)
-        hash_part = filename.split('-')[1].split('.')[0]
-        archive_data.setdefault(hash_part, {})
-        archive_data[hash_part]['ogLink'] = f"/shops/archive/og/{filename}"
+    for row in rows:
+        archive_data.setdefault(row['name'], {})
+        link = 'ogLink' if row['kind'] == 'og' else 'normalShopLink'
+        archive_data[row['name']][link] = f"/shops/{row['path']}"
+
+    return paged_response(archive_data, next_cursor)
+
+@app.get("/api/v1/archive/{shop_hash}")
+async def get_archive_hash(shop_hash: str):
+    rows = await asyncio.to_thread(catalog.lookup, shop_hash)
+    if not rows:
+        return {"error": "Hash not found"}
+    return {
+        "hash": shop_hash,
+        "images": [
+            {key: row[key] for key in ('kind', 'date', 'size', 'width', 'height', 'archived')} | {"link": f"/shops/{row['path']}"}
+            for row in rows if row['kind'] in ('shop', 'og')
+        ]
+    }
 
-    return archive_data
+def paged_response(content, next_cursor):
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return JSONResponse(content=content, headers=headers)
 
 # Dependency to check adminKey
 def check_admin_key(adminKey: str = Query(...)):
@@ -486,56 +807,53 @@ def check_admin_key(adminKey: str = Query(...)):
 async def fnggVideo(
     cosmeticid: str = Query(...)
 ):
-    fnggdata = {}
-    async with aiohttp.ClientSession() as session:
-        async with session.get('https://fortnite.gg/api/items.json') as resp:
-            if resp.status != 200:
-                print("Failed to fetch fngg data.")
-                return {"status": "Failed to fetch fngg data."}
-            data = await resp.json()
-
-            for key, value in data.items():
-                fnggdata[key.lower()] = value
-
-            cosmeticfnggid = fnggdata.get(cosmeticid.lower())
-            if cosmeticfnggid is None:
-                return {"status": "Failed to fetch fngg data for that cosmetic."}
-
-            return {
-                'status': 'success',
-                'fnggid': cosmeticfnggid,
-                'videourl': f'https://fnggcdn.com/items/{cosmeticfnggid}/video.mp4'
-            }
+    if not fngg_index.loaded:
+        return {"status": "Failed to fetch fngg data."}
+
+    cosmeticfnggid = fngg_index.lookup(cosmeticid)
+    if cosmeticfnggid is None:
+        return {"status": "Failed to fetch fngg data for that cosmetic."}
+
+    return {
+        'status': 'success',
+        'fnggid': cosmeticfnggid,
+        'videourl': fngg.video_url(cosmeticfnggid)
+    }
+
+@app.get('/api/v1/fngg/getVideos', include_in_schema=True)
+async def fnggVideos(
+    cosmeticids: List[str] = Query(...)
+):
+    if not fngg_index.loaded:
+        return {"status": "Failed to fetch fngg data."}
+
+    videos = {}
+    for cosmeticid in cosmeticids:
+        cosmeticfnggid = fngg_index.lookup(cosmeticid)
+        videos[cosmeticid] = None if cosmeticfnggid is None else {
+            'fnggid': cosmeticfnggid,
+            'videourl': fngg.video_url(cosmeticfnggid)
+        }
+
+    return {'status': 'success', 'videos': videos}
 
 
 
 @app.get("/api/v1/shop/forceRegen", include_in_schema=False)
 async def force_regen(adminKey: str = Depends(check_admin_key)):
-    print("Force regenerating shop images.")
-    async with aiohttp.ClientSession() as session:
-        async with session.get('https://fortnite-api.com/v2/shop?responseFlags=0x7') as resp:
-            if resp.status != 200:
-                print("Failed to fetch shop data.")
-                return {"status": "Failed to fetch shop data."}
-            data = await resp.json()
-            shop_data = data['data']
-            new_hash = shop_data['hash']
-            currentdate = shop_data['date'][:10]
-
-            hash_data['hash'] = new_hash
-            save_hash()
-
-            # Generate shop images
-            await genshop(session, shop_data, new_hash)
-            if checkForOgItems:
-                await ogitems(session, shop_data, new_hash)
-            else:
-                print("Og items is disabled.")
-
-            # Move old images to archive
-            move_old_images_to_archive(new_hash)
-
-            return {"status": "Shop images regenerated.", "hash": new_hash}
+    log.info("Force regenerating shop images")
+    if leader_lease.held:
+        # Joins the background poll's regeneration if one is already running.
+        job_id = job_queue.submit('regen', ('regen',), regenerate_shop).id
+    else:
+        # Only the leader generates, it picks this up within a second.
+        job_id = await asyncio.to_thread(leader.request, 'regen')
+    return {"status": "Shop regeneration queued.", "jobId": job_id, "jobLink": f"/api/v1/jobs/{job_id}"}
+
+def submit_custom(custom_params, saveAs, key, job_id=None):
+    # Identical requests for the same shop share one job.
+    job_key = ('custom', shop_state.hash, *custom_params.values(), saveAs, key)
+    return job_queue.submit('custom', job_key, lambda job: create_custom_shop(job, custom_params, saveAs, key), job_id)
 
 @app.get("/api/v1/shop/createCustom", include_in_schema=True)
 async def create_custom(
@@ -548,7 +866,7 @@ async def create_custom(
     saveAs: str = Query(...),
     key: str = Query(...)
 ):
-    print("Creating custom shop images.")
+    log.info("Creating custom shop images", extra={'key': key, 'saveAs': saveAs})
 
     # Custom parameters
     custom_params = {
@@ -559,53 +877,185 @@ async def create_custom(
         'ogThreshold': ogThresholdParam
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get('https://fortnite-api.com/v2/shop?responseFlags=0x7') as resp:
-            if resp.status != 200:
-                print("Failed to fetch shop data.")
-                return {"status": "Failed to fetch shop data."}
-            data = await resp.json()
-            shop_data = data['data']
-            new_hash = shop_data['hash']
-            currentdate = shop_data['date'][:10]
-
-            # Generate custom shop images
-            await genshop(session, shop_data, new_hash, custom=True, custom_params=custom_params, saveAs=saveAs, key=key)
-            if checkForOgItems:
-                await ogitems(session, shop_data, new_hash, custom=True, custom_params=custom_params, saveAs=saveAs, key=key)
-            else:
-                print("Og items is disabled.")
+    if leader_lease.held:
+        job_id = submit_custom(custom_params, saveAs, key).id
+    else:
+        # Rendered by the leader like forceRegen, only it runs the render pool.
+        job_id = await asyncio.to_thread(leader.request, 'custom', {'customParams': custom_params, 'saveAs': saveAs, 'key': key})
 
     # Build the URLs for the generated images
     normal_shop_link = f"/shops/custom/{key}/{saveAs}.jpg"
     og_shop_link = f"/shops/custom/{key}/og-{saveAs}.jpg"
 
     return {
-        "status": "Custom shop images created.",
+        "status": "Custom shop images queued.",
+        "jobId": job_id,
+        "jobLink": f"/api/v1/jobs/{job_id}",
         "normalShopLink": normal_shop_link,
         "ogShopLink": og_shop_link
     }
 
+@app.get("/api/v1/snapshots")
+async def get_snapshots(
+    limit: int = Query(default=100, ge=1, le=1000),
+    cursor: Optional[str] = Depends(check_cursor),
+    since: Optional[str] = Query(default=None, description="YYYY-MM-DD"),
+    until: Optional[str] = Query(default=None, description="YYYY-MM-DD")
+):
+    # Every stored /v2/shop response, newest first, paged like /api/v1/archive.
+    rows, next_cursor = await asyncio.to_thread(snapshotstore.page, limit, cursor, since, until)
+    return paged_response([
+        {
+            "hash": row['hash'],
+            "date": row['date'],
+            "entries": row['entries'],
+            "size": row['raw_size'],
+            "storedSize": row['summary_size'] + row['body_size'],
+            "link": f"/api/v1/snapshots/{row['hash']}",
+        }
+        for row in rows
+    ], next_cursor)
+
+@app.get("/api/v1/snapshots/diff")
+async def get_snapshot_diff(to: Optional[str] = None, base: Optional[str] = Query(default=None, alias="from")):
+    # Offers added, removed and changed between two stored shops, by default the newest one
+    # against the one before it.
+    new_hash = to or await asyncio.to_thread(snapshotstore.latest)
+    old_hash = base or (await asyncio.to_thread(snapshotstore.latest, new_hash) if new_hash else None)
+    changes = await asyncio.to_thread(snapshotstore.diff, old_hash, new_hash) if old_hash and new_hash else None
+    if changes is None:
+        raise HTTPException(status_code=404, detail="Both shops need to be in the snapshot store.")
+    return {"from": old_hash, "to": new_hash} | changes
+
+@app.get("/api/v1/snapshots/{shop_hash}")
+async def get_snapshot(request: Request, shop_hash: str):
+    # The stored response body as it was fetched.
+    body = await asyncio.to_thread(snapshotstore.load_body, shop_hash)
+    if body is None:
+        raise HTTPException(status_code=404, detail="Hash not found")
+    return cached_response(request, body, f'"snapshot-{shop_hash}"', "application/json", immutableCacheControl)
+
+@app.get("/api/v1/shop/items")
+async def get_shop_items(
+    type: Optional[str] = None,
+    minPrice: Optional[int] = Query(default=None, ge=0),
+    maxPrice: Optional[int] = Query(default=None, ge=0),
+    new: Optional[bool] = None,
+    minDays: Optional[int] = Query(default=None, ge=0),
+    hash: Optional[str] = None
+):
+    # Items of a shop by type (e.g. Outfit), price range, "NEW!" or days since last seen, cheapest first.
+    # card / ogCard link each item's own card, a few KB instead of the whole merged image.
+    shop_hash = hash or shop_state.hash
+    index = await item_index(shop_hash)
+    if index is None:
+        raise HTTPException(status_code=404, detail="No snapshot of that shop is available.")
+
+    items = index.query(type, minPrice, maxPrice, new, minDays)
+    return {
+        "hash": shop_hash,
+        "date": index.date,
+        "count": len(items),
+        "items": items
+    }
+
+@app.get("/api/v1/og")
+async def get_og(threshold: int = Query(default=ogThreshold, ge=0), hash: Optional[str] = None):
+    # Which items of a shop clear the threshold, straight from its parsed snapshot (no rendering).
+    shop_hash = hash or shop_state.hash
+    snapshot = await shop_snapshot(shop_hash)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="No snapshot of that shop is available.")
+    shop_date, entries = snapshot
+
+    resultlist = sorted((entry for entry in entries if entry.og_days >= threshold), key=lambda x: x.og_days, reverse=True)
+    return {
+        "hash": shop_hash,
+        "date": shop_date[:10],
+        "threshold": threshold,
+        "count": len(resultlist),
+        "items": [
+            {
+                "id": item.id,
+                "name": item.item_name,
+                "type": item.type,
+                "price": item.price,
+                "days": item.og_days,
+                "lastSeen": item.last_seen,
+                "image": item.og_url,
+            }
+            for item in resultlist
+        ],
+        "imageLink": f"/api/v1/og/image?threshold={threshold}&hash={shop_hash}" if resultlist else None
+    }
+
+def submit_og(shop_hash, threshold, job_id=None):
+    return job_queue.submit('og', ('og', shop_hash, threshold), lambda job: render_og_threshold(job, shop_hash, threshold), job_id)
+
+@app.get("/api/v1/og/image")
+async def get_og_image(request: Request, threshold: int = Query(default=ogThreshold, ge=0), hash: Optional[str] = None):
+    # Rendered on first request, then served from gridcache.og_renders. Requests for the same
+    # (hash, threshold) while it renders wait for the same job.
+    shop_hash = hash or shop_state.hash
+    path = gridcache.og_render(shop_hash, threshold)
+    if path is None and not leader_lease.held and os.path.exists(gridcache.og_render_path(shop_hash, threshold)):
+        path = gridcache.og_render_path(shop_hash, threshold)  # Rendered by the leader already
+    if path is None:
+        if await shop_snapshot(shop_hash) is None:
+            raise HTTPException(status_code=404, detail="No snapshot of that shop is available.")
+        if leader_lease.held:
+            job = submit_og(shop_hash, threshold)
+            await job.done.wait()
+            record = job.to_dict()
+        else:
+            job_id = await asyncio.to_thread(leader.request, 'og', {'hash': shop_hash, 'threshold': threshold})
+            record = await leader.wait_for(job_id)
+        if record is None or record['status'] != 'done':
+            raise HTTPException(status_code=500, detail="Rendering the OG image failed.")
+        path = record['result']["path"]
+        if path is None:
+            raise HTTPException(status_code=404, detail="No items clear that threshold.")
+
+    async with aiofiles.open(path, 'rb') as f:
+        body = await f.read()
+    # Same shop and threshold always render the same image.
+    return cached_response(request, body, f'"og-{shop_hash}-{threshold}"', "image/jpeg", immutableCacheControl)
+
+@app.get("/api/v1/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_queue.get(job_id) or background_queue.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    # Ran (or runs) on another worker
+    record = await asyncio.to_thread(jobs.read_record, job_id)
+    if record is None:
+        return {"error": "Job not found"}
+    return record
+
 @app.get("/api/v1/customShopsAll", include_in_schema=False)
-async def get_custom_shops_all(adminKey: str = Depends(check_admin_key)):
+async def get_custom_shops_all(
+    adminKey: str = Depends(check_admin_key),
+    limit: int = Query(default=100, ge=1, le=1000),
+    cursor: Optional[str] = Depends(check_cursor),
+    since: Optional[str] = Query(default=None, description="YYYY-MM-DD"),
+    until: Optional[str] = Query(default=None, description="YYYY-MM-DD")
+):
+    rows, next_cursor = await asyncio.to_thread(catalog.custom_page, limit, cursor, None, since, until)
     custom_shops = {}
-    # Iterate over all keys (directories) in shops/custom/
-    key_dirs = [d for d in glob.glob('shops/custom/*') if os.path.isdir(d)]
-    for key_dir in key_dirs:
-        key = os.path.basename(key_dir)
-        custom_shops[key] = []
-        for filepath in glob.glob(os.path.join(key_dir, '*.jpg')):
-            filename = os.path.basename(filepath)
-            custom_shops[key].append(f"/shops/custom/{key}/{filename}")
-    return custom_shops
+    for row in rows:
+        custom_shops.setdefault(row['key'], []).append(f"/shops/{row['path']}")
+    return paged_response(custom_shops, next_cursor)
 
 @app.get("/api/v1/customShops/{key}")
-async def get_custom_shops_key(key: str):
-    key_dir = os.path.join('shops/custom', key)
-    if not os.path.exists(key_dir):
+async def get_custom_shops_key(
+    key: str,
+    limit: int = Query(default=100, ge=1, le=1000),
+    cursor: Optional[str] = Depends(check_cursor),
+    since: Optional[str] = Query(default=None, description="YYYY-MM-DD"),
+    until: Optional[str] = Query(default=None, description="YYYY-MM-DD")
+):
+    if not await asyncio.to_thread(catalog.has_custom_key, key):
         return {"error": "Key not found"}
-    custom_shops = []
-    for filepath in glob.glob(os.path.join(key_dir, '*.jpg')):
-        filename = os.path.basename(filepath)
-        custom_shops.append(f"/shops/custom/{key}/{filename}")
-    return {"key": key, "customShops": custom_shops}
+    rows, next_cursor = await asyncio.to_thread(catalog.custom_page, limit, cursor, key, since, until)
+    custom_shops = [f"/shops/{row['path']}" for row in rows]
+    return paged_response({"key": key, "customShops": custom_shops}, next_cursor)
@@ -1,27 +1,109 @@
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageDraw
 import os
+import shutil
+import threading
 from math import ceil, sqrt
 from datetime import date
 
+from fonts import get_font, measure_text, largest_fitting_size
+import catalog
+import tiles
+from jobs import job_stage
+from logs import get_logger
+import metrics
+
 # =========== #
 fontPath = 'assets/BurbankBigRegular-BlackItalic.otf'  # The path to the font you want to use
 
 shopbgPath = "assets/shopbg.png"  # Path to shop background
 # =========== #
 
-def merger(ogitems, datas=None, save_as='', currentdate=None, shop_hash=None, custom=False, title_text=None, showDate=None, saveAsName=None, key=None):
-    if not datas:
-        if not ogitems:
-            print("[MERGER] OG Items is false, getting files from cache")
-            list_ = [os.path.join('cache', file) for file in os.listdir('cache') if
-                     file.endswith('.png') and not file.startswith('temp')]
-        else:
-            print("[MERGER] OG Items is true, getting files from ogcache")
-            list_ = [os.path.join('ogcache', file) for file in os.listdir('ogcache') if file.endswith('.png')]
-        datas = [Image.open(i).convert("RGBA") for i in sorted(list_)]
+log = get_logger('merger')
+
+image_items = metrics.Gauge('image_items', 'Cards in the last merged image.', ['image'])
+image_width = metrics.Gauge('image_width_pixels', 'Width of the last merged image.', ['image'])
+image_height = metrics.Gauge('image_height_pixels', 'Height of the last merged image.', ['image'])
+image_bytes = metrics.Gauge('image_bytes', 'Encoded size of the last merged image.', ['image'])
+
+def background_strip(bg_tile, width, y0, height):
+    # Horizontal slice [y0, y0 + height) of the tiled shop background, tiles aligned to the full canvas.
+    strip = Image.new("RGBA", (width, height))
+    tile_width, tile_height = bg_tile.size
+    for x in range(0, width, tile_width):
+        for y in range(y0 - y0 % tile_height, y0 + height, tile_height):
+            strip.paste(bg_tile, (x, y - y0))
+    return strip
+
+def grid_layout(count):
+    # (cards per row, number of rows) for count cards
+    rowslen = ceil(sqrt(count))
+    return rowslen, ceil(count / rowslen)
+
+def grid_row(cards, bg_tile, width, row_y, px=512):
+    # One row of cards on its slice of the background, as RGB.
+    strip = background_strip(bg_tile, width, row_y, px)
+    for x, card in enumerate(cards):
+        if card.size != (px, px):
+            card = card.resize((px, px))
+        strip.paste(card, (x * px, 0), card)
+    return strip.convert("RGB")
+
+def grid_rows(datas, bg_tile, px=512, top=322):
+    # Yields (y, RGB strip) for each row of cards, y being where the row sits on the full canvas.
+    rowslen, columnslen = grid_layout(len(datas))
+    for y in range(columnslen):
+        row_y = y * px + top
+        yield row_y, grid_row(datas[y * rowslen:(y + 1) * rowslen], bg_tile, rowslen * px, row_y, px)
+
+def compose_grid(datas, px=512, top=322):
+    # Every card row without the title band, for callers that want to merge the same cards under several titles.
+    rowslen, columnslen = grid_layout(len(datas))
+    bg_tile = Image.open(shopbgPath).convert("RGBA")
+    grid = Image.new("RGB", (rowslen * px, columnslen * px))
+    for row_y, strip in grid_rows(datas, bg_tile, px, top):
+        grid.paste(strip, (0, row_y - top))
+    return grid
+
+class GridBuilder:
+    # compose_grid for cards that arrive one by one in any order: a row is composed as soon as its
+    # last card is in, so only the rows still waiting on a card are left when the last one lands.
+    # add() and compose_row() may run on different threads.
+
+    def __init__(self, count, px=512, top=322):
+        self.px = px
+        self.top = top
+        self.rowslen, columnslen = grid_layout(count)
+        self.bg_tile = Image.open(shopbgPath).convert("RGBA")
+        self.grid = Image.new("RGB", (self.rowslen * px, columnslen * px))
+        self.cards = [None] * count
+        self.waiting = [min(self.rowslen, count - y * self.rowslen) for y in range(columnslen)]
+        self.lock = threading.Lock()
+
+    def add(self, index, card):
+        # Returns the row this card completed, if any.
+        with self.lock:
+            self.cards[index] = card
+            y = index // self.rowslen
+            self.waiting[y] -= 1
+            return y if self.waiting[y] == 0 else None
+
+    def compose_row(self, y):
+        row_y = y * self.px + self.top
+        strip = grid_row(self.cards[y * self.rowslen:(y + 1) * self.rowslen], self.bg_tile, self.grid.width, row_y, self.px)
+        with self.lock:
+            self.grid.paste(strip, (0, row_y - self.top))
 
-    if not datas:
-        print("[MERGER] No images to merge.")
+    @property
+    def complete(self):
+        return not any(self.waiting)
+
+def merger(ogitems, datas=None, save_as='', currentdate=None, shop_hash=None, custom=False, title_text=None, showDate=None, saveAsName=None, key=None, work_dir=None, grid=None, job=None):
+    # datas are the cards in merge order, or grid the same cards already composed (see compose_grid).
+    if datas is None and grid is None:
+        raise ValueError("merger needs the cards (datas) or their grid")
+
+    if not datas and grid is None:
+        log.info("No images to merge")
         return
 
     if title_text is None:
@@ -29,78 +111,51 @@ def merger(ogitems, datas=None, save_as='', currentdate=None, shop_hash=None, cu
     if showDate is None:
         showDate = True
 
-    row_n = len(datas)
-    rowslen = ceil(sqrt(row_n))
-    columnslen = ceil(row_n / rowslen)
-
     px = 512
     title_area_height = 322
-    total_width = rowslen * px
-    total_height = columnslen * px + title_area_height
+    if grid is not None:
+        total_width, total_height = grid.width, grid.height + title_area_height
+    else:
+        rowslen, columnslen = grid_layout(len(datas))
+        total_width = rowslen * px
+        total_height = columnslen * px + title_area_height
 
     bg_tile = Image.open(shopbgPath).convert("RGBA")
-    bg_tile_width, bg_tile_height = bg_tile.size
-
-    background = Image.new("RGBA", (total_width, total_height))
 
-    for x in range(0, total_width, bg_tile_width):
-        for y in range(0, total_height, bg_tile_height):
-            background.paste(bg_tile, (x, y))
+    # Only the final RGB canvas spans the whole image, everything RGBA is one strip (title band or grid row) at a time.
+    final_image = Image.new("RGB", (total_width, total_height))
 
-    draw = ImageDraw.Draw(background)
+    title_strip = background_strip(bg_tile, total_width, 0, title_area_height)
+    draw = ImageDraw.Draw(title_strip)
 
-    font_size = 150
     max_font_size = 200
     min_title_font_size = 60
 
-    def measure_text(text, font):
-        try:
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-        except AttributeError:
-            text_width, text_height = draw.textsize(text, font=font)
-        return text_width, text_height
-
     max_width = total_width - 40
 
+    def text_block_height(text, size):
+        text_height = measure_text(fontPath, size, text)[1]
+        if showDate:
+            return text_height + max(int(size * 0.5), 30) + 20
+        return text_height
+
+    def title_fits(text):
+        return lambda size: (measure_text(fontPath, size, text)[0] <= max_width
+                             and text_block_height(text, size) <= title_area_height)
+
     display_title_text = title_text
 
-    while font_size >= min_title_font_size:
-        font = ImageFont.truetype(fontPath, font_size)
-        text_width, text_height = measure_text(display_title_text, font)
-        if text_width <= max_width:
-            break
-        font_size -= 2
-    else:
+    font_size = largest_fitting_size(title_fits(display_title_text), min_title_font_size, max_font_size)
+    if font_size is None:
+        # Too long even at the smallest size, cut it down to what fits and try again.
+        text_width = measure_text(fontPath, min_title_font_size, display_title_text)[0]
         max_chars = int(len(display_title_text) * (max_width / text_width))
         display_title_text = display_title_text[:max_chars] + '...'
-        font = ImageFont.truetype(fontPath, font_size)
-        text_width, text_height = measure_text(display_title_text, font)
-
-    if showDate:
-        font_date_size = max(int(font_size * 0.5), 30)
-        total_text_height = text_height + font_date_size + 20
-    else:
-        total_text_height = text_height
-
-    while font_size < max_font_size:
-        next_font_size = font_size + 2
-        font = ImageFont.truetype(fontPath, next_font_size)
-        text_width, text_height = measure_text(display_title_text, font)
-        if text_width > max_width:
-            break
-        if showDate:
-            font_date_size = max(int(next_font_size * 0.5), 30)
-            total_text_height = text_height + font_date_size + 20
-        else:
-            total_text_height = text_height
-        if total_text_height > title_area_height:
-            break
-        font_size = next_font_size
+        font_size = largest_fitting_size(title_fits(display_title_text), min_title_font_size, max_font_size) or min_title_font_size - 2
 
-    font = ImageFont.truetype(fontPath, font_size)
-    text_width, text_height = measure_text(display_title_text, font)
+    font = get_font(fontPath, font_size)
+    text_width, text_height = measure_text(fontPath, font_size, display_title_text)
+    total_text_height = text_block_height(display_title_text, font_size)
     if showDate:
         font_date_size = max(int(font_size * 0.5), 30)
 
@@ -116,20 +171,17 @@ def merger(ogitems, datas=None, save_as='', currentdate=None, shop_hash=None, cu
             date_text = currentdate
 
         date_y_position = title_y_position + text_height + 20
-        font_date = ImageFont.truetype(fontPath, font_date_size)
+        font_date = get_font(fontPath, font_date_size)
         draw.text((total_width / 2, date_y_position), date_text, font=font_date, fill='white', anchor='mt')
 
-    idx = 0
-    for y in range(columnslen):
-        for x in range(rowslen):
-            if idx >= len(datas):
-                break
-            card = datas[idx]
-            card = card.resize((px, px))
-            background.paste(card, (x * px, y * px + title_area_height), card)
-            idx += 1
+    final_image.paste(title_strip.convert("RGB"), (0, 0))
+    del title_strip, draw
 
-    final_image = background.convert("RGB")
+    if grid is not None:
+        final_image.paste(grid, (0, title_area_height))
+    else:
+        for row_y, strip in grid_rows(datas, bg_tile, px, title_area_height):
+            final_image.paste(strip, (0, row_y))
 
     if currentdate is None:
         date_text = date.today().strftime("%Y-%m-%d")
@@ -139,9 +191,13 @@ def merger(ogitems, datas=None, save_as='', currentdate=None, shop_hash=None, cu
     if shop_hash is None:
         shop_hash = 'unknown'
 
-    if custom:
+    catalogued = not save_as
+    if save_as:
+        # An explicit path is a private render (like /api/v1/og/image), not a catalogued shop image.
+        os.makedirs(os.path.dirname(save_as) or '.', exist_ok=True)
+    elif custom:
         if key is None or saveAsName is None:
-            print("[MERGER] Error: 'key' and 'saveAsName' must be provided for custom images.")
+            log.error("'key' and 'saveAsName' must be provided for custom images")
             return
         save_dir = os.path.join('shops', 'custom', key)
         os.makedirs(save_dir, exist_ok=True)
@@ -157,7 +213,45 @@ def merger(ogitems, datas=None, save_as='', currentdate=None, shop_hash=None, cu
             os.makedirs('shops', exist_ok=True)
             save_as = f"shops/shop-{shop_hash}.jpg"
 
-    final_image.save(save_as, optimize=True, quality=85)
+    pyramid = None
+    if tiles.tileOutput and catalogued and not custom:
+        pyramid = tiles.Pyramid(final_image, os.path.splitext(os.path.basename(save_as))[0]).start()
+
+    try:
+        with job_stage(job, f"{'og' if ogitems else 'shop'} encode"):
+            if work_dir:
+                # Encode inside the job's own folder and move it into place once complete,
+                # so nobody is ever served (or archives) a half written image.
+                tmp_path = os.path.join(work_dir, os.path.basename(save_as))
+                final_image.save(tmp_path, format='JPEG', optimize=True, quality=85)
+                shutil.move(tmp_path, save_as)
+            else:
+                final_image.save(save_as, optimize=True, quality=85)
+    except BaseException:
+        if pyramid:
+            pyramid.abandon()
+        raise
+
+    if pyramid:
+        # Whatever the tile threads haven't done while the full image encoded.
+        with job_stage(job, f"{'og' if ogitems else 'shop'} tiles"):
+            pyramid.finish()
+
+    image = 'og' if ogitems else 'shop'
+    if custom:
+        image = f'custom-{image}'
+    elif not catalogued:
+        image = f'render-{image}'
+    if datas is not None:
+        image_items.set(len(datas), image=image)
+    image_width.set(final_image.width, image=image)
+    image_height.set(final_image.height, image=image)
+    image_bytes.set(os.path.getsize(save_as), image=image)
+
+    if catalogued and custom:
+        catalog.record(save_as, 'custom', saveAsName, date_text, *final_image.size, key=key)
+    elif catalogued:
+        catalog.record(save_as, 'og' if ogitems else 'shop', shop_hash, date_text, *final_image.size)
 
-    print(f"[MERGER] Image saved as {save_as}")
+    log.info("Image saved", extra={'path': save_as})
     return final_image
@@ -0,0 +1,136 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# =========== #
+metricsPrefix = 'shopapi_'  # Prepended to every metric name
+stageBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # Seconds, for pipeline stages
+requestBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds, for HTTP requests
+# =========== #
+
+# Just enough of the Prometheus text format for what this app exports. Updates are a dict lookup
+# under a lock, and nothing is formatted until /metrics is scraped.
+
+_lock = threading.Lock()
+_metrics = []
+_collectors = []
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = metricsPrefix + name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        _metrics.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def samples(self):
+        with _lock:
+            values = dict(self.values)
+        return [f'{self.name}{label_text(self.labels, key)} {format_value(value)}' for key, value in sorted(values.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with _lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=stageBuckets):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with _lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{label_text(self.labels, key, [("le", format_value(float(bound)))])} {cumulative}')
+            lines.append(f'{self.name}_sum{label_text(self.labels, key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{label_text(self.labels, key)} {cumulative}')
+        return lines
+
+
+def register_collector(collect):
+    # collect() is called on every scrape and returns [(name, kind, documentation, [(labels dict, value)])],
+    # for numbers that already live somewhere else (like the HTTP client's counters).
+    _collectors.append(collect)
+
+
+def render():
+    lines = []
+    for metric in list(_metrics):
+        lines.extend(metric.header())
+        lines.extend(metric.samples())
+    for collect in list(_collectors):
+        for name, kind, documentation, samples in collect():
+            name = metricsPrefix + name
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{label_text(labels.keys(), labels.values())} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
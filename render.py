@@ -0,0 +1,193 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw
+
+from cardcache import CardCache, card_key, file_digest
+from fonts import get_font
+from logs import get_logger
+
+# =========== #
+renderWorkers = None  # Number of render processes, None uses every core
+renderBackend = 'pil'  # 'pil' draws card by card, 'numpy' composites batches of cards at once (see batchrender.py)
+renderBatchSize = 8  # Cards per batch with the numpy backend (~2 MB of memory per card while it runs)
+# =========== #
+
+log = get_logger('render')
+
+card_cache = CardCache()  # Rendered cards, kept between runs (see cardcache.py)
+
+# Per-worker state, loaded once by init_worker instead of being shipped with every task.
+_overlay = None
+_overlay_array = None
+_overlay_digest = None
+_font_path = None
+
+_pool = None
+_pool_lock = threading.Lock()
+_backend = 'pil'  # Backend the running pool was started with
+
+
+def init_worker(overlay_path, font_path, backend='pil'):
+    global _overlay, _overlay_array, _overlay_digest, _font_path
+    _overlay = Image.open(overlay_path).convert('RGBA')
+    _overlay_digest = file_digest(overlay_path)
+    _font_path = font_path
+    for size in (15, 35, 40):
+        get_font(font_path, size)
+    if backend == 'numpy':
+        import numpy as np
+        _overlay_array = np.asarray(_overlay, dtype=np.uint16)
+
+
+def batch_backend_ok(overlay_path, font_path):
+    # The numpy backend re-implements Pillow's blending, check it still agrees with this Pillow
+    # on a sample card before trusting it.
+    try:
+        import batchrender
+    except ImportError:
+        log.warning("numpy is not installed, rendering cards with PIL")
+        return False
+    init_worker(overlay_path, font_path, 'numpy')
+    background = Image.radial_gradient('L').resize((512, 512)).convert('RGBA')
+    background.putalpha(Image.linear_gradient('L').resize((512, 512)))
+    layers = card_layers('Sample Item', last_seen_text('12'), 1500)
+    expected = draw_card(background, layers)
+    batch = batchrender.compose([background, background], _overlay_array, [layers, layers], _font_path)
+    if batch[0].tobytes() != expected.tobytes() or batch[1].tobytes() != expected.tobytes():
+        log.warning("numpy backend doesn't match PIL with this Pillow version, rendering cards with PIL")
+        return False
+    return True
+
+
+def warm_up():
+    return os.getpid()
+
+
+def start_pool(overlay_path, font_path, workers=renderWorkers, backend=None):
+    global _pool, _backend
+    with _pool_lock:  # Jobs can get here from several threads at once
+        if _pool is not None and _pool._broken:
+            # A worker died (OOM kill and the like), which breaks the whole executor for good.
+            log.warning("Render workers died, starting new ones", extra={'reason': str(_pool._broken)})
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+        if _pool is None:
+            workers = workers or os.cpu_count() or 1
+            _backend = backend or renderBackend
+            if _backend == 'numpy' and not batch_backend_ok(overlay_path, font_path):
+                _backend = 'pil'
+            _pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(overlay_path, font_path, _backend))
+            # Workers are spawned lazily, so push one no-op per worker to pay for spawn and init now.
+            for future in [_pool.submit(warm_up) for _ in range(workers)]:
+                future.result()
+            log.info("Started render workers", extra={'workers': workers, 'backend': _backend})
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+        log.info("Render workers stopped")
+
+
+def last_seen_text(diff):
+    return 'NEW!' if 'NEW!' in diff else f'LAST SEEN: {diff} day{"s" if diff != "1" else ""} ago'
+
+
+def card_layers(name, diff_text, price):
+    # (text, font size, anchor point) drawn onto every card, in drawing order.
+    return [
+        (name, 35, (256, 420)),
+        (diff_text, 15, (256, 450)),
+        (f'{price}', 40, (256, 505)),
+    ]
+
+
+def open_background(source):
+    with Image.open(source) as background:
+        return background.resize((512, 512)).convert('RGBA')
+
+
+def draw_card(background, layers):
+    img = Image.new("RGBA", (512, 512))
+    img.paste(background)
+
+    img.paste(_overlay, (0, 0), _overlay)
+
+    draw = ImageDraw.Draw(img)
+    for text, size, xy in layers:
+        draw.text(xy, text, font=get_font(_font_path, size), fill='white', anchor='ms')
+    return img
+
+
+def cached_card(task):
+    # (key, cached result or None) for a render task
+    filename, source, name, diff_text, price = task
+    key = card_key(source, name, diff_text, price, _overlay_digest, _font_path)
+    cached = card_cache.get(key)
+    if cached:
+        with Image.open(cached) as img:
+            return key, (filename, img.convert('RGBA').tobytes(), True)
+    return key, None
+
+
+def render_card(task):
+    # task is a small (filename, source, name, diff_text, price) tuple, returns (filename, RGBA bytes, from card cache).
+    filename, source, name, diff_text, price = task
+    try:
+        key, cached = cached_card(task)
+        if cached:
+            return cached
+
+        img = draw_card(open_background(source), card_layers(name, diff_text, price))
+        card_cache.put(key, img)
+        return filename, img.tobytes(), False
+    except Exception as e:
+        log.error("Error processing item", extra={'card': filename, 'error': str(e)})
+
+
+def render_batch(tasks):
+    # numpy backend: the same results as render_card for each task, with the overlay and text of
+    # every card missing from the card cache composited in one go.
+    import batchrender
+
+    results = [None] * len(tasks)
+    pending = []
+    for index, task in enumerate(tasks):
+        filename, source, name, diff_text, price = task
+        try:
+            key, cached = cached_card(task)
+            if cached:
+                results[index] = cached
+            else:
+                pending.append((index, key, open_background(source), card_layers(name, diff_text, price)))
+        except Exception as e:
+            log.error("Error processing item", extra={'card': filename, 'error': str(e)})
+
+    if pending:
+        cards = batchrender.compose([item[2] for item in pending], _overlay_array, [item[3] for item in pending], _font_path)
+        for (index, key, _, _), card in zip(pending, cards):
+            card_cache.put(key, Image.fromarray(card, 'RGBA'))
+            results[index] = (tasks[index][0], card.tobytes(), False)
+    return results
+
+
+def render_single(task):
+    return [render_card(task)]
+
+
+def batch_size():
+    # Cards worth handing to one submit_all call, for callers that get their tasks one at a time.
+    return renderBatchSize if _backend == 'numpy' else 1
+
+
+def submit_all(tasks):
+    # Futures that resolve to lists of render results, one card per future with the PIL
+    # backend and one batch per future with the numpy backend.
+    pool = _pool
+    if _backend == 'numpy':
+        return [pool.submit(render_batch, tasks[i:i + renderBatchSize]) for i in range(0, len(tasks), renderBatchSize)]
+    return [pool.submit(render_single, task) for task in tasks]
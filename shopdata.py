@@ -0,0 +1,74 @@
+from datetime import date
+
+
+class ShopEntry:
+    # One renderable shop offer, flattened out of the raw /v2/shop entry.
+    __slots__ = (
+        'id', 'filename', 'name', 'item_name', 'type', 'price', 'bundle',
+        'url', 'og_url', 'last_seen', 'days', 'og_days',
+        'source', 'og_source',
+    )
+
+    @property
+    def diff(self):
+        # "Last seen" value shown on the normal card.
+        return 'NEW!' if self.last_seen is None else str(self.days or 1)
+
+
+def display_asset_url(obj):
+    new_display_asset = obj.get('newDisplayAsset', {})
+    material_instances = new_display_asset.get('materialInstances', [])
+    if material_instances:
+        images = material_instances[0].get('images', {})
+        return images.get('Background') or images.get('OfferImage')
+    render_images = new_display_asset.get('renderImages', [])
+    if render_images:
+        return render_images[0].get('image')
+    return None
+
+
+def normalize_shop(shop_data):
+    # Returns (currentdate, [ShopEntry]) with everything genshop and ogitems need, in one pass.
+    currentdate = shop_data['date'][:10]
+    today = date.fromisoformat(currentdate)
+    entries = []
+
+    for i in shop_data.get('entries') or []:
+        if i.get('offerTag', {}).get('id', "") == "sparksjamloop":
+            continue
+        if i.get('tracks'):
+            continue
+        if not i.get('brItems'):
+            continue
+
+        item = i['brItems'][0]
+        shop_history = item.get('shopHistory', [])
+
+        entry = ShopEntry()
+        entry.id = item['id']
+        entry.item_name = item['name']
+        entry.type = item['type']['displayValue']
+        entry.price = i['finalPrice']
+        entry.last_seen = shop_history[-2][:10] if len(shop_history) >= 2 else None
+        entry.days = (today - date.fromisoformat(entry.last_seen)).days if entry.last_seen else None
+        entry.og_days = entry.days if entry.last_seen else 0
+
+        # OG cards always show the item itself, the normal card shows the offer (or its bundle).
+        entry.og_url = display_asset_url(item) or item['images']['icon']
+
+        if i.get('bundle'):
+            entry.bundle = i['bundle']['name']
+            entry.url = i['bundle']['image']
+            entry.filename = f"zzz{i['bundle']['name']}"
+            entry.name = i['bundle']['name']
+        else:
+            entry.bundle = None
+            entry.url = display_asset_url(i) or item['images']['icon']
+            entry.filename = item['id']
+            entry.name = item['name']
+
+        entry.source = None
+        entry.og_source = None
+        entries.append(entry)
+
+    return currentdate, entries
@@ -0,0 +1,58 @@
+from bisect import bisect_left, bisect_right
+
+from cardfiles import card_link, card_name
+
+
+class ItemIndex:
+    # The items of one shop for /api/v1/shop/items, serialized once and ordered by price, so a
+    # price range is two bisects and the other filters only look at what's inside it.
+    __slots__ = ('hash', 'date', 'items', 'prices', 'by_type', 'new')
+
+    def __init__(self, shop_hash, shop_date, entries, cards=(), og_threshold=None):
+        # cards are the names saved by cardfiles for this shop, links are only given for those.
+        self.hash = shop_hash
+        self.date = shop_date[:10]
+        self.items = []
+        for entry in sorted(entries, key=lambda entry: (entry.price, entry.item_name, entry.id)):
+            og = og_threshold is not None and entry.og_days >= og_threshold
+            self.items.append({
+                "id": entry.id,
+                "name": entry.item_name,
+                "type": entry.type,
+                "price": entry.price,
+                "bundle": entry.bundle,
+                "new": entry.last_seen is None,
+                "lastSeen": entry.last_seen,
+                "days": entry.days,
+                "image": entry.url,
+                "card": card_link(shop_hash, entry.filename) if card_name(entry.filename) in cards else None,
+                "ogCard": card_link(shop_hash, f"OG{entry.id}") if og and card_name(f"OG{entry.id}") in cards else None,
+            })
+        self.prices = [item["price"] for item in self.items]
+        self.by_type = {}
+        for position, item in enumerate(self.items):
+            self.by_type.setdefault((item["type"] or '').lower(), []).append(position)
+        self.new = [position for position, item in enumerate(self.items) if item["new"]]
+
+    def query(self, item_type=None, min_price=None, max_price=None, new=None, min_days=None):
+        low = 0 if min_price is None else bisect_left(self.prices, min_price)
+        high = len(self.items) if max_price is None else bisect_right(self.prices, max_price)
+
+        # Start from the smallest list a filter hands us, then check the rest item by item.
+        if item_type is not None:
+            positions = self.by_type.get(item_type.lower(), [])
+            positions = positions[bisect_left(positions, low):bisect_left(positions, high)]
+        elif new:
+            positions = self.new[bisect_left(self.new, low):bisect_left(self.new, high)]
+        else:
+            positions = range(low, high)
+
+        items = []
+        for position in positions:
+            item = self.items[position]
+            if new is not None and item["new"] != new:
+                continue
+            if min_days is not None and (item["days"] is None or item["days"] < min_days):
+                continue
+            items.append(item)
+        return items
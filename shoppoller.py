@@ -0,0 +1,104 @@
+import asyncio
+import hashlib
+import random
+import time
+
+from jobs import job_stage
+from logs import get_logger
+
+# =========== #
+shopUrl = 'https://fortnite-api.com/v2/shop'
+shopRotationTime = (0, 0)  # (hour, minute) in UTC when the item shop rotates
+shopRotationWindowBefore = 2 * 60  # Seconds before the rotation to start polling fast
+shopRotationWindowAfter = 20 * 60  # Seconds after the rotation to keep polling fast (unless the new shop was already found)
+shopFastPollInterval = 15  # Seconds between polls inside the rotation window
+shopSlowPollInterval = 15 * 60  # Seconds between polls the rest of the day
+shopErrorBackoff = 30  # Seconds to wait after a failed poll, doubled for every failure in a row
+shopErrorBackoffMax = 30 * 60  # Longest wait between polls while upstream keeps failing
+# =========== #
+
+log = get_logger('poll')
+
+DAY = 24 * 60 * 60
+
+
+class ShopPoller:
+    # Polls /v2/shop with conditional requests, so an unchanged shop costs a 304 (or at worst a
+    # body compare) instead of a JSON decode. Polls fast around the daily rotation, slow otherwise.
+
+    def __init__(self, url=shopUrl):
+        self.url = url
+        self.etag = None
+        self.last_modified = None
+        self.body_digest = None
+        self.failures = 0
+        self.found_window = None  # Start of the rotation window the new shop was already found in
+
+    def rotation_offset(self, now):
+        # Seconds since the last rotation
+        hour, minute = shopRotationTime
+        return (now - hour * 3600 - minute * 60) % DAY
+
+    def window_start(self, now):
+        return now - (self.rotation_offset(now) + shopRotationWindowBefore) % DAY
+
+    def in_window(self, now):
+        offset = self.rotation_offset(now)
+        return offset <= shopRotationWindowAfter or offset >= DAY - shopRotationWindowBefore
+
+    def next_delay(self, now=None):
+        if now is None:
+            now = time.time()
+        if self.failures:
+            delay = min(shopErrorBackoff * 2 ** (self.failures - 1), shopErrorBackoffMax)
+            return delay * random.uniform(0.8, 1.2)
+        offset = self.rotation_offset(now)
+        if self.in_window(now):
+            if self.found_window != self.window_start(now):
+                return shopFastPollInterval
+            # This rotation's shop is already out, go back to slow polling once the window is over.
+            wait = (shopRotationWindowAfter - offset) % DAY
+        else:
+            wait = (DAY - shopRotationWindowBefore - offset) % DAY
+        return max(min(wait, shopSlowPollInterval), 1)
+
+    async def poll(self, client, on_shop):
+        # on_shop(shop_data, body) gets every shop that differs from the last one handled (body being
+        # the response as fetched) and returns whether it was a new shop. The validators are only kept
+        # once it succeeds, so a shop that failed to generate is fetched and handled again on the next poll.
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        with job_stage(None, 'poll'):
+            resp = await client.fetch(self.url, headers=headers)
+        if resp.status == 304:
+            return False
+        if resp.status != 200:
+            raise RuntimeError(f"fortnite-api.com returned {resp.status}")
+
+        digest = hashlib.sha1(resp.body).hexdigest()
+        if digest == self.body_digest:
+            # No validators from upstream, but the same bytes as last time.
+            return False
+
+        changed = await on_shop(resp.json()['data'], resp.body)
+        self.etag = resp.headers.get('ETag')
+        self.last_modified = resp.headers.get('Last-Modified')
+        self.body_digest = digest
+        return changed
+
+    async def run(self, client, on_shop):
+        while True:
+            try:
+                changed = await self.poll(client, on_shop)
+                self.failures = 0
+                now = time.time()
+                if changed and self.in_window(now):
+                    self.found_window = self.window_start(now)
+            except Exception as e:
+                self.failures += 1
+                log.warning("Shop poll failed", extra={'failures': self.failures, 'error': str(e)})
+            await asyncio.sleep(self.next_delay())
@@ -0,0 +1,25 @@
+import json
+
+import tiles
+from webcache import strong_etag
+
+
+class ShopState:
+    # Everything / and /api/v1/info serve for one shop hash, rendered once up front.
+    # A new state is built for every new hash and swapped in whole, never modified.
+    __slots__ = ('hash', 'info', 'info_body', 'info_etag', 'page_body', 'page_etag')
+
+    def __init__(self, shop_hash, templates):
+        self.hash = shop_hash
+        self.info = {
+            "hash": shop_hash,
+            "normalShopLink": f"/shops/shop-{shop_hash}.jpg",
+            "ogShopLink": f"/shops/og/og-{shop_hash}.jpg"
+        }
+        if tiles.tileOutput:
+            self.info["normalShopTiles"] = f"/shops/tiles/shop-{shop_hash}.dzi"
+            self.info["ogShopTiles"] = f"/shops/tiles/og-{shop_hash}.dzi"
+        self.info_body = json.dumps(self.info, separators=(',', ':')).encode('utf-8')
+        self.info_etag = strong_etag(self.info_body)
+        self.page_body = templates.get_template("index.html").render(hash=shop_hash, tiles=tiles.tileOutput).encode('utf-8')
+        self.page_etag = strong_etag(self.page_body)
@@ -0,0 +1,256 @@
+import fcntl
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from contextlib import closing
+
+from catalog import encode_cursor, decode_cursor
+from logs import get_logger
+
+# =========== #
+snapshotDir = 'snapshots'  # Every /v2/shop response seen, compressed, plus the index over them
+snapshotCompression = 9  # zlib level, a few writes a day so the smallest output wins
+# =========== #
+
+log = get_logger('snapshots')
+
+# shops.log is append-only, one record per distinct shop hash:
+#   header, hash, date, zlib(summary JSON), zlib(response body as fetched)
+# The summary is the handful of fields per offer that listing and diffing need, so neither has to
+# inflate and decode a multi-megabyte body. index.db maps hash -> record and is rebuilt from the
+# log whenever it's behind (deleted, or a crash between the append and the insert).
+HEADER = struct.Struct('>4sHHIII')  # magic, hash length, date length, summary size, body size, raw body size
+MAGIC = b'SHP1'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    hash TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    summary_size INTEGER NOT NULL,
+    body_size INTEGER NOT NULL,
+    raw_size INTEGER NOT NULL,
+    entries INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_date ON snapshots (date, created);
+"""
+
+INSERT = "INSERT OR IGNORE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+# Item lists an offer can carry, depending on what it sells.
+ITEM_KINDS = ('brItems', 'tracks', 'instruments', 'cars', 'legoKits')
+
+_lock = threading.Lock()
+
+
+def log_path():
+    return os.path.join(snapshotDir, 'shops.log')
+
+
+def connect():
+    os.makedirs(snapshotDir, exist_ok=True)
+    db = sqlite3.connect(os.path.join(snapshotDir, 'index.db'))
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def offer_name(entry):
+    if entry.get('bundle'):
+        return entry['bundle'].get('name')
+    for kind in ITEM_KINDS:
+        for item in entry.get(kind) or []:
+            return item.get('name') or item.get('title')
+    return entry.get('devName')
+
+
+def summarize(data):
+    # One small dict per offer, keyed for diff() by offerId.
+    offers = []
+    for entry in data.get('entries') or []:
+        items = [item.get('id') for kind in ITEM_KINDS for item in entry.get(kind) or []]
+        offers.append({
+            'id': entry.get('offerId') or entry.get('devName') or ','.join(map(str, items)),
+            'name': offer_name(entry),
+            'price': entry.get('finalPrice'),
+            'regularPrice': entry.get('regularPrice'),
+            'items': items,
+            'inDate': entry.get('inDate'),
+            'outDate': entry.get('outDate'),
+        })
+    return offers
+
+
+def sync(db):
+    # Indexes whatever the log holds past the last indexed record, returns where the indexed part ends.
+    end = db.execute("SELECT COALESCE(MAX(end), 0) FROM snapshots").fetchone()[0]
+    rows = []
+    if os.path.exists(log_path()) and os.path.getsize(log_path()) > end:
+        with open(log_path(), 'rb') as f:
+            f.seek(end)
+            while True:
+                offset = f.tell()
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                magic, hash_size, date_size, summary_size, body_size, raw_size = HEADER.unpack(header)
+                if magic != MAGIC:
+                    log.error("Snapshot log is corrupt, indexing stopped", extra={'offset': offset})
+                    break
+                shop_hash = f.read(hash_size).decode()
+                shop_date = f.read(date_size).decode()
+                summary = f.read(summary_size)
+                f.seek(body_size, os.SEEK_CUR)
+                if len(summary) < summary_size or f.tell() > os.fstat(f.fileno()).st_size:
+                    break  # Still being written, or torn by a crash (add() cuts that off)
+                entries = len(json.loads(zlib.decompress(summary)))
+                end = f.tell()
+                rows.append((shop_hash, shop_date, offset, end, summary_size, body_size, raw_size, entries, time.time()))
+    if rows:
+        with db:
+            db.executemany(INSERT, rows)
+        log.info("Indexed snapshots from the log", extra={'snapshots': len(rows)})
+    return end
+
+
+def add(body, data=None):
+    # body is the /v2/shop response exactly as fetched, data its already decoded "data" if the caller
+    # has it. Returns False when that hash is already stored.
+    if data is None:
+        data = json.loads(body)['data']
+    shop_hash, shop_date = data['hash'], data['date']
+    if lookup(shop_hash):
+        return False  # The poller and fetch_shop see the same shop again and again, skip compressing it
+
+    offers = summarize(data)
+    summary = zlib.compress(json.dumps(offers, separators=(',', ':')).encode(), snapshotCompression)
+    packed = zlib.compress(body, snapshotCompression)
+    hash_bytes, date_bytes = shop_hash.encode(), shop_date.encode()
+    header = HEADER.pack(MAGIC, len(hash_bytes), len(date_bytes), len(summary), len(packed), len(body))
+
+    # flock keeps appends from several server processes whole, _lock does the same for threads.
+    with _lock, closing(connect()) as db, open(log_path(), 'ab') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        offset = sync(db)
+        if db.execute("SELECT 1 FROM snapshots WHERE hash = ?", (shop_hash,)).fetchone():
+            return False
+        if os.fstat(f.fileno()).st_size > offset:
+            f.truncate(offset)  # A record torn by a crash, nobody else can be writing now
+
+        f.seek(offset)
+        f.write(header + hash_bytes + date_bytes + summary + packed)
+        f.flush()
+        os.fsync(f.fileno())
+        end = f.tell()
+        with db:
+            db.execute(INSERT, (shop_hash, shop_date, offset, end, len(summary), len(packed), len(body), len(offers), time.time()))
+
+    log.info("Stored shop snapshot", extra={'hash': shop_hash, 'bytes': len(packed), 'raw_bytes': len(body)})
+    return True
+
+
+def lookup(shop_hash):
+    with closing(connect()) as db:
+        sync(db)
+        row = db.execute("SELECT * FROM snapshots WHERE hash = ?", (shop_hash,)).fetchone()
+    return dict(row) if row else None
+
+
+def read_block(row, which):
+    # Reads and inflates the summary or the body of an indexed record.
+    header_size = HEADER.size + len(row['hash'].encode()) + len(row['date'].encode())
+    start = row['offset'] + header_size
+    size = row['summary_size']
+    if which == 'body':
+        start, size = start + row['summary_size'], row['body_size']
+    with open(log_path(), 'rb') as f:
+        f.seek(start)
+        return zlib.decompress(f.read(size))
+
+
+def load_body(shop_hash):
+    # The stored response body, byte for byte. None if the hash was never stored.
+    row = lookup(shop_hash)
+    return read_block(row, 'body') if row else None
+
+
+def load(shop_hash):
+    # The "data" of the stored response, what fetch_shop returns for a live one.
+    body = load_body(shop_hash)
+    return json.loads(body)['data'] if body is not None else None
+
+
+def load_summary(shop_hash):
+    row = lookup(shop_hash)
+    return json.loads(read_block(row, 'summary')) if row else None
+
+
+def latest(before=None):
+    # Hash of the newest snapshot, or of the one right before the snapshot `before`.
+    with closing(connect()) as db:
+        sync(db)
+        if before is None:
+            row = db.execute("SELECT hash FROM snapshots ORDER BY date DESC, created DESC LIMIT 1").fetchone()
+        else:
+            row = db.execute(
+                "SELECT s.hash FROM snapshots s, snapshots b WHERE b.hash = ? AND (s.date, s.created) < (b.date, b.created) "
+                "ORDER BY s.date DESC, s.created DESC LIMIT 1",
+                (before,)
+            ).fetchone()
+    return row['hash'] if row else None
+
+
+def page(limit, cursor=None, since=None, until=None):
+    # Newest first, like catalog.archive_page. Returns (rows, next_cursor).
+    where = ["1 = 1"]
+    params = []
+    if since:
+        where.append("date >= ?")
+        params.append(since)
+    if until:
+        where.append("substr(date, 1, 10) <= ?")
+        params.append(until)
+    if cursor:
+        where.append("(date, created) < (?, ?)")
+        params.extend(decode_cursor(cursor))
+
+    with closing(connect()) as db:
+        sync(db)
+        rows = db.execute(
+            f"SELECT * FROM snapshots WHERE {' AND '.join(where)} ORDER BY date DESC, created DESC LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+    next_cursor = encode_cursor([rows[limit - 1]['date'], rows[limit - 1]['created']]) if len(rows) > limit else None
+    return [dict(row) for row in rows[:limit]], next_cursor
+
+
+def diff(old_hash, new_hash):
+    # Offers added, removed and changed between two stored shops, from their summaries only.
+    old, new = load_summary(old_hash), load_summary(new_hash)
+    if old is None or new is None:
+        return None
+    old = {offer['id']: offer for offer in old}
+    new = {offer['id']: offer for offer in new}
+
+    changed = []
+    for offer_id in new.keys() & old.keys():
+        changes = {
+            field: [old[offer_id][field], value]
+            for field, value in new[offer_id].items() if old[offer_id].get(field) != value
+        }
+        if changes:
+            changed.append({'id': offer_id, 'name': new[offer_id]['name'], 'changes': changes})
+
+    by_name = lambda offer: (offer['name'] or '', offer['id'] or '')
+    return {
+        'added': sorted((new[offer_id] for offer_id in new.keys() - old.keys()), key=by_name),
+        'removed': sorted((old[offer_id] for offer_id in old.keys() - new.keys()), key=by_name),
+        'changed': sorted(changed, key=by_name),
+    }
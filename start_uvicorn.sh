@@ -1,2 +1,3 @@
 #!/bin/bash
-uvicorn main:app --host 147.135.119.47 --port 999
+# Every worker serves, the one holding work/leader.lock also polls and generates (see leader.py).
+uvicorn main:app --host 147.135.119.47 --port 999 --workers ${WORKERS:-$(nproc)}
@@ -2,24 +2,95 @@ document.addEventListener('DOMContentLoaded', () => {
     const itemShopBtn = document.getElementById('itemShopBtn');
     const ogBtn = document.getElementById('ogBtn');
     const shopImage = document.getElementById('shopImage');
+    const tileViewer = document.getElementById('tileViewer');
     const hash = window.shopHash; // Retrieve the hash from the global variable
+    let currentSrc = `/shops/shop-${hash}.jpg`; // Full image of what's shown, for the modal
 
     function loadImage(src) {
         const img = new Image();
         img.onload = () => {
             shopImage.src = src;
+            tileViewer.style.display = 'none';
+            shopImage.style.display = '';
             shopImage.style.opacity = 1;
         };
         img.src = src;
     }
 
+    // Deep zoom viewer: lays out the tiles of the smallest pyramid level that is still sharp at this
+    // width, and lets the browser lazy load them, so only what's on screen is ever fetched.
+    async function loadTiles(name, fallbackSrc) {
+        try {
+            const response = await fetch(`/shops/tiles/${name}.dzi`);
+            if (!response.ok) {
+                throw new Error(`${response.status}`);
+            }
+            const dzi = new DOMParser().parseFromString(await response.text(), 'application/xml').documentElement;
+            const size = dzi.getElementsByTagName('Size')[0];
+            const width = parseInt(size.getAttribute('Width'));
+            const height = parseInt(size.getAttribute('Height'));
+            const tileSize = parseInt(dzi.getAttribute('TileSize'));
+            const maxLevel = Math.ceil(Math.log2(Math.max(width, height)));
+
+            tileViewer.style.display = 'block';
+            shopImage.style.display = 'none';
+            const wanted = tileViewer.clientWidth * (window.devicePixelRatio || 1);
+            let level = maxLevel;
+            while (level > 0 && Math.ceil(width / 2 ** (maxLevel - level + 1)) >= wanted) {
+                level--;
+            }
+            const scale = 2 ** (maxLevel - level);
+            const levelWidth = Math.ceil(width / scale);
+            const levelHeight = Math.ceil(height / scale);
+
+            const tiles = [];
+            for (let row = 0; row * tileSize < levelHeight; row++) {
+                for (let col = 0; col * tileSize < levelWidth; col++) {
+                    const tile = document.createElement('img');
+                    tile.loading = 'lazy';
+                    tile.decoding = 'async';
+                    tile.alt = '';
+                    tile.style.left = `${100 * col * tileSize / levelWidth}%`;
+                    tile.style.top = `${100 * row * tileSize / levelHeight}%`;
+                    tile.style.width = `${100 * Math.min(tileSize, levelWidth - col * tileSize) / levelWidth}%`;
+                    tile.style.height = `${100 * Math.min(tileSize, levelHeight - row * tileSize) / levelHeight}%`;
+                    tile.src = `/shops/tiles/${name}_files/${level}/${col}_${row}.jpg`;
+                    tiles.push(tile);
+                }
+            }
+            tileViewer.style.aspectRatio = `${width} / ${height}`;
+            tileViewer.replaceChildren(...tiles);
+            tileViewer.style.opacity = 1;
+        } catch (error) {
+            loadImage(fallbackSrc); // No pyramid for this image, show the whole JPEG
+        }
+    }
+
+    function show(name, src) {
+        currentSrc = src;
+        if (window.shopTiles) {
+            loadTiles(name, src);
+        } else {
+            loadImage(src);
+        }
+    }
+
+    function hide() {
+        shopImage.style.opacity = 0;
+        tileViewer.style.opacity = 0;
+    }
+
+    if (window.shopTiles) {
+        show(`shop-${hash}`, `/shops/shop-${hash}.jpg`);
+    }
+
     itemShopBtn.addEventListener('click', () => {
         if (!itemShopBtn.classList.contains('active')) {
             itemShopBtn.classList.add('active');
             ogBtn.classList.remove('active');
-            shopImage.style.opacity = 0;
+            hide();
             setTimeout(() => {
-                loadImage(`/shops/shop-${hash}.jpg`);
+                show(`shop-${hash}`, `/shops/shop-${hash}.jpg`);
             }, 300);
         }
     });
@@ -28,9 +99,9 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!ogBtn.classList.contains('active')) {
             ogBtn.classList.add('active');
             itemShopBtn.classList.remove('active');
-            shopImage.style.opacity = 0;
+            hide();
             setTimeout(() => {
-                loadImage(`/shops/og/og-${hash}.jpg`);
+                show(`og-${hash}`, `/shops/og/og-${hash}.jpg`);
             }, 300);
         }
     });
@@ -40,10 +111,13 @@ document.addEventListener('DOMContentLoaded', () => {
     const modalImage = document.getElementById('modalImage');
     const closeModal = document.getElementById('closeModal');
 
-    shopImage.addEventListener('click', () => {
-        modalImage.src = shopImage.src;
+    function openModal() {
+        modalImage.src = currentSrc;
         imageModal.style.display = 'block';
-    });
+    }
+
+    shopImage.addEventListener('click', openModal);
+    tileViewer.addEventListener('click', openModal);
 
     closeModal.addEventListener('click', () => {
         imageModal.style.display = 'none';
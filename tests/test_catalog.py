@@ -0,0 +1,39 @@
+import os
+import shutil
+
+import pytest
+from PIL import Image
+
+import catalog
+
+
+@pytest.fixture
+def shops(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, 'catalogPath', str(tmp_path / 'catalog.db'))
+    monkeypatch.setattr(catalog, 'shopsDir', str(tmp_path / 'shops'))
+    os.makedirs(tmp_path / 'shops' / 'archive')
+    return tmp_path / 'shops'
+
+
+def publish(shops, shop_hash):
+    path = shops / f'shop-{shop_hash}.jpg'
+    Image.new('RGB', (8, 8)).save(path)
+    catalog.record(str(path), 'shop', shop_hash, '2024-10-01', 8, 8)
+
+
+def archive(shops, new_hash):
+    # What main.move_old_images_to_archive does for the normal images.
+    for image in catalog.current_images(new_hash):
+        archived = shops / 'archive' / os.path.basename(image['path'])
+        shutil.move(shops / image['path'], archived)
+        catalog.mark_archived(str(shops / image['path']), str(archived))
+
+
+def test_repeated_hash_archives_again(shops):
+    for shop_hash in ('aaaa', 'bbbb', 'aaaa', 'cccc'):
+        publish(shops, shop_hash)
+        archive(shops, shop_hash)
+
+    rows = catalog.lookup('aaaa')
+    assert [(row['path'], row['archived']) for row in rows] == [('archive/shop-aaaa.jpg', 1)]
+    assert [row['path'] for row in catalog.current_images('')] == ['shop-cccc.jpg']
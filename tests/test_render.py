@@ -0,0 +1,59 @@
+import os
+import signal
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from PIL import Image
+
+import render
+from cardcache import CardCache
+from conftest import ROOT
+
+OVERLAY = os.path.join(ROOT, 'assets', 'overlay.png')
+FONT = os.path.join(ROOT, 'assets', 'BurbankBigRegular-BlackItalic.otf')
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    monkeypatch.setattr(render, 'card_cache', CardCache(str(tmp_path / 'cardcache')))
+    good = tmp_path / 'good.png'
+    Image.new('RGBA', (256, 256), (40, 80, 120, 255)).save(good)
+    bad = tmp_path / 'bad.png'
+    bad.write_bytes(b'not an image')
+    return str(good), str(bad)
+
+
+def task(filename, source):
+    return (filename, source, 'Item', render.last_seen_text('12'), 800)
+
+
+def test_render_card_skips_corrupt_image(sources):
+    good, bad = sources
+    render.init_worker(OVERLAY, FONT)
+    assert render.render_card(task('bad', bad)) is None
+    filename, data, cached = render.render_card(task('good', good))
+    assert (filename, len(data), cached) == ('good', 512 * 512 * 4, False)
+
+
+def test_render_batch_skips_corrupt_image(sources):
+    pytest.importorskip('numpy')
+    good, bad = sources
+    render.init_worker(OVERLAY, FONT, 'numpy')
+    results = render.render_batch([task('bad', bad), task('good', good)])
+    assert results[0] is None
+    assert results[1][0] == 'good' and len(results[1][1]) == 512 * 512 * 4
+
+
+def test_start_pool_replaces_broken_pool():
+    pool = render.start_pool(OVERLAY, FONT, workers=1, backend='pil')
+    try:
+        pid = pool.submit(render.warm_up).result()
+        os.kill(pid, signal.SIGKILL)
+        with pytest.raises(BrokenProcessPool):
+            pool.submit(render.warm_up).result(timeout=10)
+
+        fresh = render.start_pool(OVERLAY, FONT, workers=1, backend='pil')
+        assert fresh is not pool
+        assert fresh.submit(render.warm_up).result(timeout=10) != pid
+    finally:
+        render.shutdown_pool()
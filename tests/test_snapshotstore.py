@@ -0,0 +1,25 @@
+import json
+
+import pytest
+
+import snapshotstore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshotstore, 'snapshotDir', str(tmp_path / 'snapshots'))
+
+
+def body(shop_hash):
+    data = {'hash': shop_hash, 'date': '2024-10-01T00:00:00Z', 'entries': [{'offerId': 'v2:/1', 'finalPrice': 800}]}
+    return json.dumps({'status': 200, 'data': data}).encode()
+
+
+def test_add_skips_stored_hash_before_compressing(store, monkeypatch):
+    assert snapshotstore.add(body('aaaa'))
+
+    def compress(*args):
+        raise AssertionError("compressed a shop that is already stored")
+    monkeypatch.setattr(snapshotstore.zlib, 'compress', compress)
+    assert not snapshotstore.add(body('aaaa'))
+    assert snapshotstore.load_body('aaaa') == body('aaaa')
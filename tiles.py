@@ -0,0 +1,109 @@
+import math
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from logs import get_logger
+
+# =========== #
+tileOutput = False  # Also write every shop / OG image as a Deep Zoom (DZI) tile pyramid for the viewer
+tileDir = 'shops/tiles'  # Pyramids live here, served by the /shops mount
+tileSize = 256  # Side of a tile in px
+tileQuality = 80  # JPEG quality of the tiles
+tileThreads = 4  # Tiles encoded at the same time
+# =========== #
+
+log = get_logger('tiles')
+
+# Layout (what OpenSeadragon and friends read):
+#   {name}.dzi                        the image size and tile size
+#   {name}_files/{level}/{col}_{row}.jpg
+# Level L is the image scaled by 1 / 2 ** (max_level - L), max_level being the full size and level 0 one pixel.
+
+DZI = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+       '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="jpg" Overlap="0" TileSize="{size}">'
+       '<Size Width="{width}" Height="{height}"/></Image>\n')
+
+_pool = None
+
+
+def pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(tileThreads, thread_name_prefix='tiles')
+    return _pool
+
+
+def save_tile_row(level_image, folder, row):
+    # One row of tiles, so a task is worth the hop to another thread.
+    top = row * tileSize
+    bottom = min(top + tileSize, level_image.height)
+    for col in range(math.ceil(level_image.width / tileSize)):
+        left = col * tileSize
+        tile = level_image.crop((left, top, min(left + tileSize, level_image.width), bottom))
+        tile.save(os.path.join(folder, f'{col}_{row}.jpg'), quality=tileQuality)
+
+
+class Pyramid:
+    # start() hands the tiles to the pool and returns right away, so they encode while merger is
+    # still encoding the full image. finish() waits and moves the pyramid into place.
+
+    def __init__(self, image, name):
+        self.image = image
+        self.name = name
+        self.tmp_dir = os.path.join(tileDir, f'.{name}-{os.getpid()}.tmp')
+        self.futures = []
+
+    def start(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        max_level = math.ceil(math.log2(max(self.image.size)))
+        level_image = self.image
+        for level in range(max_level, -1, -1):
+            folder = os.path.join(self.tmp_dir, str(level))
+            os.makedirs(folder)
+            self.futures.extend(
+                pool().submit(save_tile_row, level_image, folder, row)
+                for row in range(math.ceil(level_image.height / tileSize))
+            )
+            if level:
+                # reduce() rounds up like DZI does, ceil(size / 2) at every level.
+                level_image = level_image.reduce(2)
+        return self
+
+    def finish(self):
+        wait(self.futures)
+        for future in self.futures:
+            future.result()  # Raises the first failure
+
+        files_dir = os.path.join(tileDir, f'{self.name}_files')
+        dzi_path = os.path.join(tileDir, f'{self.name}.dzi')
+        # A finished pyramid is one with its .dzi, so that goes last (and first when replacing one).
+        for path in (dzi_path, files_dir):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        os.rename(self.tmp_dir, files_dir)
+        with open(dzi_path + '.tmp', 'w') as f:
+            f.write(DZI.format(size=tileSize, width=self.image.width, height=self.image.height))
+        os.replace(dzi_path + '.tmp', dzi_path)
+        log.info("Tile pyramid saved", extra={'path': dzi_path, 'tiles': sum(len(files) for _, _, files in os.walk(files_dir))})
+        return dzi_path
+
+    def abandon(self):
+        wait(self.futures)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def prune(keep_hash):
+    # Pyramids of older shops aren't linked anywhere once a new one is out (their JPEGs are archived).
+    if not os.path.isdir(tileDir):
+        return
+    for entry in os.scandir(tileDir):
+        name = entry.name[:-len('.dzi')] if entry.name.endswith('.dzi') else entry.name.rsplit('_files', 1)[0]
+        if name.split('-', 1)[-1] == keep_hash:
+            continue
+        if entry.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.remove(entry.path)
@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, features
+
+from logs import get_logger
+
+# =========== #
+variantDir = 'variants'  # Resized / re-encoded copies of the shop images (kept outside the public shops/ mount)
+variantWidths = (400, 1200)  # Widths for ?w= (thumbnail, medium), a request is rounded up to the next one
+variantFormats = ('avif', 'webp', 'jpeg')  # Formats offered through the Accept header, best first
+variantSaveOptions = {  # Encoder settings per format
+    'jpeg': {'quality': 85, 'optimize': True},
+    'webp': {'quality': 80, 'method': 4},
+    'avif': {'quality': 60, 'speed': 8},
+}
+variantMaxBytes = 512 * 1024 * 1024  # Evict least recently used variants above this size
+variantThreads = 4  # Variants of one image encoded at the same time
+eagerVariants = True  # Derive every variant of a new shop right after it's published, instead of on first request
+# =========== #
+
+log = get_logger('variants')
+
+MEDIA_TYPES = {'jpeg': 'image/jpeg', 'webp': 'image/webp', 'avif': 'image/avif'}
+EXTENSIONS = {'jpeg': 'jpg', 'webp': 'webp', 'avif': 'avif'}
+
+# Formats this Pillow build can actually encode
+available_formats = [fmt for fmt in variantFormats if fmt == 'jpeg' or features.check(fmt)]
+
+_inflight = {}
+
+
+def negotiate_format(accept, requested=None):
+    # ?format= wins when it names a format we have, otherwise the best one the Accept header lists.
+    if requested in available_formats:
+        return requested
+    accept = accept or ''
+    for fmt in available_formats:
+        if MEDIA_TYPES[fmt] in accept:
+            return fmt
+    return 'jpeg'
+
+
+def snap_width(requested, width):
+    # Only the configured widths are ever derived, so ?w= can't fill the disk with one file per pixel.
+    try:
+        requested = int(requested)
+    except (TypeError, ValueError):
+        return None
+    if requested <= 0:
+        return None
+    for candidate in sorted(variantWidths):
+        if candidate >= requested:
+            return candidate if candidate < width else None
+    return None
+
+
+def variant_path(source, stat_result, width, fmt):
+    # Keyed by name, size and mtime, so an archived image keeps its variants and an overwritten
+    # custom image gets new ones.
+    identity = f'{os.path.basename(source)}\0{stat_result.st_size}\0{stat_result.st_mtime_ns}'
+    digest = hashlib.sha1(identity.encode('utf-8')).hexdigest()[:20]
+    return os.path.join(variantDir, f'{digest}-{width or "full"}.{EXTENSIONS[fmt]}')
+
+
+def derive(source, stat_result, width, fmt, image=None):
+    path = variant_path(source, stat_result, width, fmt)
+    try:
+        os.utime(path)  # mtime doubles as the LRU clock
+        return path
+    except FileNotFoundError:
+        pass
+
+    if image is None:
+        with Image.open(source) as img:
+            image = img.convert('RGB')
+    if width:
+        image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+
+    os.makedirs(variantDir, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    image.save(tmp_path, format=fmt.upper(), **variantSaveOptions[fmt])
+    os.replace(tmp_path, path)
+    return path
+
+
+async def get_variant(source, stat_result, width, fmt):
+    # Derives on first request; concurrent requests for the same variant share one encode.
+    path = variant_path(source, stat_result, width, fmt)
+    try:
+        os.utime(path)  # A hit counts for evict() too, same LRU clock as derive
+        return path
+    except FileNotFoundError:
+        pass
+    task = _inflight.get(path)
+    if task is None:
+        task = asyncio.create_task(asyncio.to_thread(derive_and_evict, source, stat_result, width, fmt))
+        _inflight[path] = task
+        task.add_done_callback(lambda _: _inflight.pop(path, None))
+    return await asyncio.shield(task)
+
+
+def derive_and_evict(source, stat_result, width, fmt):
+    path = derive(source, stat_result, width, fmt)
+    evict()
+    return path
+
+
+def generate_all(sources):
+    # Every width/format combination of the given images, encoded in parallel (Pillow releases the GIL).
+    jobs = []
+    for source in sources:
+        if not os.path.exists(source):
+            continue
+        stat_result = os.stat(source)
+        with Image.open(source) as img:
+            image = img.convert('RGB')
+        widths = [None] + [width for width in sorted(variantWidths) if width < image.width]
+        for width in widths:
+            for fmt in available_formats:
+                if width is None and fmt == 'jpeg':
+                    continue  # That's the original
+                jobs.append((source, stat_result, width, fmt, image))
+
+    with ThreadPoolExecutor(variantThreads) as pool:
+        list(pool.map(lambda job: derive(*job), jobs))
+    log.info("Generated variants", extra={'variants': len(jobs)})
+    evict()
+
+
+def evict():
+    if not os.path.isdir(variantDir):
+        return
+    entries = [e for e in os.scandir(variantDir) if not e.name.endswith('.tmp')]
+    total = sum(e.stat().st_size for e in entries)
+    if total <= variantMaxBytes:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    removed = 0
+    for entry in entries:
+        if total <= variantMaxBytes:
+            break
+        try:
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    log.info("Evicted variants", extra={'evicted': removed})
@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import re
+import stat
+
+from fastapi import Request, Response
+from fastapi.staticfiles import StaticFiles
+from PIL import Image
+
+import variants
+
+# =========== #
+revalidateCacheControl = 'no-cache'  # For responses that change with the shop (/, /api/v1/info)
+immutableCacheControl = 'public, max-age=31536000, immutable'  # For files whose name contains their shop hash
+# =========== #
+
+# shop-{hash}.jpg / og-{hash}.jpg never change once written, custom shops can be overwritten.
+CONTENT_ADDRESSED = re.compile(r'^(shop|og)-[0-9a-f]+\.jpg$')
+# Same for their tile pyramids (see tiles.py), which are also never worth a variant.
+TILES = re.compile(r'^tiles/(shop|og)-[0-9a-f]+(\.dzi|_files/\d+/\d+_\d+\.jpg)$')
+mimetypes.add_type('application/xml', '.dzi')
+# And the cards saved on their own (see cardfiles.py).
+CARDS = re.compile(r'^cards/[0-9a-f]+/[A-Za-z0-9_-]+\.webp$')
+
+
+def strong_etag(body):
+    return f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+def etag_matches(request: Request, etag):
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in if_none_match.split(',')]
+
+
+def cached_response(request: Request, body, etag, media_type, cache_control=revalidateCacheControl):
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+class ShopStaticFiles(StaticFiles):
+    # StaticFiles that marks the hash-named shop images as immutable, and serves a smaller or
+    # better compressed variant of a .jpg when asked with ?w= or an Accept header (see variants.py).
+
+    def cache_control(self, full_path):
+        relative = path_of(full_path, self.directory)
+        if not relative.startswith('custom') and CONTENT_ADDRESSED.match(os.path.basename(full_path)):
+            return immutableCacheControl
+        if is_tile(relative) or is_card(relative):
+            return immutableCacheControl
+        return None
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        cache_control = self.cache_control(full_path)
+        if cache_control:
+            response.headers['Cache-Control'] = cache_control
+        if str(full_path).endswith('.jpg') and not is_tile(path_of(full_path, self.directory)):
+            response.headers['Vary'] = 'Accept'
+        return response
+
+    async def get_response(self, path, scope):
+        request = Request(scope)
+        requested_width = request.query_params.get('w')
+        fmt = variants.negotiate_format(request.headers.get('accept'), request.query_params.get('format'))
+        if not path.endswith('.jpg') or scope['method'] not in ('GET', 'HEAD') or (not requested_width and fmt == 'jpeg') or is_tile(path):
+            return await super().get_response(path, scope)
+
+        full_path, stat_result = await asyncio.to_thread(self.lookup_path, path)
+        if not stat_result or not stat.S_ISREG(stat_result.st_mode):
+            return await super().get_response(path, scope)  # Same 404 as usual
+
+        width = None
+        if requested_width:
+            width = variants.snap_width(requested_width, await asyncio.to_thread(image_width, full_path))
+        if width is None and fmt == 'jpeg':
+            return self.file_response(full_path, stat_result, scope)
+
+        variant = await variants.get_variant(full_path, stat_result, width, fmt)
+        response = super().file_response(variant, os.stat(variant), scope)
+        if response.status_code == 200:
+            response.headers['Content-Type'] = variants.MEDIA_TYPES[fmt]
+        cache_control = self.cache_control(full_path)
+        if cache_control:
+            response.headers['Cache-Control'] = cache_control
+        response.headers['Vary'] = 'Accept'
+        return response
+
+
+def path_of(full_path, directory):
+    return os.path.relpath(full_path, directory).replace(os.sep, '/')
+
+
+def is_tile(path):
+    return TILES.match(path) is not None
+
+
+def is_card(path):
+    return CARDS.match(path) is not None
+
+
+def image_width(path):
+    with Image.open(path) as img:
+        return img.width